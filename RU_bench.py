@@ -0,0 +1,302 @@
+"""
+Sweep throughput benchmarks on simulated instruments (RU_sim).
+Reports points per second and where the time of a sweep point goes, so
+speed regressions of RU_meas can be tracked without lab hardware.
+
+    python RU_bench.py --points 20 --latency 0.002 --json bench.json
+"""
+
+import sys, io, time, json, argparse, contextlib, subprocess
+import numpy as np
+import RU_meas
+import RU_sim
+import RU_profile
+
+def quiet():
+    """
+    drivers print on every initialization and BalAtten call
+    """
+    return contextlib.redirect_stdout(io.StringIO())
+
+def runSweep(name,backend,instruments,point,values):
+    """
+    call point(value) for every value and return a result dictionary
+    """
+    backend.resetStats()
+    for instr in instruments:
+        instr.settleTimes = []
+        instr.writesSaved = 0
+    with quiet():
+        t0 = time.time()
+        for value in values:
+            point(value)
+        total = time.time()-t0
+    breakdown = {}
+    for instr,(calls,busy) in sorted(backend.stats().items()):
+        if calls:
+            breakdown[instr] = {'calls':calls,'seconds':busy}
+    for instr in instruments:
+        num,settle = instr.settleStats()[0:2]
+        if num:
+            breakdown['%s settle' % instr.__class__.__name__] = {'calls':num,'seconds':settle}
+    # settle times include the readiness polls, which are also bus time
+    accounted = sum(b['seconds'] for b in breakdown.values())
+    breakdown['python'] = {'calls':0,'seconds':max(total-accounted,0.0)}
+    saved = dict((instr.__class__.__name__,instr.writesSaved) for instr in instruments if instr.writesSaved)
+    return {'sweep':name,'points':len(values),'seconds':total,
+            'points_per_s':len(values)/total,'breakdown':breakdown,
+            'writes_saved':saved}
+
+def benchFlux(backend,num_points):
+    """
+    flux sweep: bias current, one spectrum and one temperature per point
+    """
+    with quiet():
+        bias = RU_meas.K2602()
+        ATS = RU_meas.ATS_spec(8192,4000,1)
+        LS = RU_meas.LakeShore()
+    freq = np.arange(2.5,10,0.1)
+    def point(B):
+        bias.setB_uA(B)
+        ATS.measure(freq)
+        LS.readTemp(1)
+    return runSweep('flux',backend,[bias,ATS,LS],point,np.linspace(-1500,1500,num_points))
+
+def benchGain(backend,num_points):
+    """
+    gain map: pump and signal sources, balanced attenuation, spectrum, T1/T2
+    """
+    with quiet():
+        pump = RU_meas.Gigatronics(6)
+        sgen = RU_meas.Anristu_sgen()
+        attBank = RU_meas.Aeroflex()
+        ATS = RU_meas.ATS_spec(8192,4000,1)
+        LS = RU_meas.LakeShore()
+    freq = np.arange(4,7,0.01)
+    def point(pumpPow):
+        pump.setFreqPow(5.2,pumpPow)
+        sgen.setFreqPow(4.0,-20)
+        attBank.BalAtten(20)
+        ATS.measure(freq)
+        LS.readTemp(1)
+        LS.readTemp(2)
+    return runSweep('gain',backend,[pump,sgen,attBank,ATS,LS],point,np.linspace(-10,10,num_points))
+
+def benchConcurrent(backend,num_points):
+    """
+    pump, signal, attenuation and bias set together with applySetpoints
+    """
+    with quiet():
+        PSG = RU_meas.AgilentPSG()
+        sgen = RU_meas.Anristu_sgen()
+        attBank = RU_meas.Aeroflex()
+        bias = RU_meas.K2602()
+    def point(i):
+        RU_meas.applySetpoints({PSG.setFreq:5.0+0.01*i,
+                                sgen.setFreqPow:(4.0+0.01*i,-20),
+                                attBank.BalAtten:i%40,
+                                bias.setB_uA:10*i})
+    return runSweep('setpts',backend,[PSG,sgen,attBank,bias],point,range(num_points))
+
+def benchPSG(backend,num_points):
+    """
+    pump frequency sweep on the PSG
+    """
+    with quiet():
+        PSG = RU_meas.AgilentPSG()
+        ATS = RU_meas.ATS_spec(8192,4000,1)
+    freq = np.arange(4,7,0.01)
+    def point(f):
+        PSG.setFreq(f)
+        PSG.setPower(0)
+        ATS.measure(freq)
+    return runSweep('psg',backend,[PSG,ATS],point,np.linspace(5,6,num_points))
+
+def benchList(backend,num_points):
+    """
+    signal frequency trace from the PSG hardware list, one sweep per point
+    """
+    with quiet():
+        PSG = RU_meas.AgilentPSG()
+    freq = np.linspace(4,7,101)
+    def point(power):
+        for f,p in RU_meas.ListSweep(PSG,freq,power):
+            pass
+    return runSweep('list',backend,[PSG],point,np.linspace(-20,0,num_points))
+
+def benchRamp(backend,num_points):
+    """
+    flux ramp from a script on the source meter, one trigger per point
+    """
+    with quiet():
+        bias = RU_meas.K2602("GPIB::26::INSTR")
+    ramp = RU_meas.BiasRamp(bias,np.linspace(-1500,1500,num_points))
+    steps = iter(ramp)
+    def point(B):
+        next(steps)
+    result = runSweep('ramp',backend,[bias,bias.tsp],point,ramp.B)
+    steps.close()
+    return result
+
+benchmarks = [benchFlux,benchGain,benchPSG,benchConcurrent,benchList,benchRamp]
+
+#############################################################################
+        #Analysis benchmarks, need RU_plot and its config
+
+def timeit(func,*args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time()-t0,result
+
+def benchReshape(num_x=1000,num_y=1000):
+    """
+    TWPAdata getParaArray/to2DZ on a num_x*num_y map against the row loops
+    they replaced
+    """
+    import RU_plot
+    entry = RU_plot.TWPAdata.__new__(RU_plot.TWPAdata)
+    entry.labels = ['SignalFreq(Hz)','SignalPow(dBm)','Mag(dB)']
+    x = np.linspace(4e9,7e9,num_x)
+    y = np.linspace(-40,0,num_y)
+    entry.data = np.column_stack((np.tile(x,num_y),np.repeat(y,num_x),np.random.rand(num_x*num_y)))
+    entry.num_rows = entry.data.shape[0]
+    entry.index = np.arange(entry.num_rows)
+
+    def loopParaArray(index):
+        rows = np.reshape(entry.data[:,index],(entry.num_rows//entry.X.size,entry.X.size))
+        return np.array([np.average(row) for row in rows])
+    def loopTo2DZ(i):
+        t = entry.data[:,i]
+        index = np.reshape(entry.index,(entry.Y.size,entry.X.size))
+        return np.array([t[row] for row in index]).transpose()
+
+    t_x,entry.X = timeit(entry.getX,'SignalFreq(Hz)','SignalPow(dBm)')
+    t_new,entry.Y = timeit(entry.getY,'SignalPow(dBm)')
+    t_old,Y = timeit(loopParaArray,1)
+    t_newZ,Z = timeit(entry.to2DZ,'Mag(dB)')
+    t_oldZ,Zold = timeit(loopTo2DZ,2)
+    assert np.allclose(Y,entry.Y) and np.array_equal(Z,Zold)
+    n = entry.num_rows
+    breakdown = {'getX':{'calls':1,'seconds':t_x},
+                 'getParaArray loop':{'calls':1,'seconds':t_old},
+                 'getParaArray':{'calls':1,'seconds':t_new},
+                 'to2DZ loop':{'calls':1,'seconds':t_oldZ},
+                 'to2DZ':{'calls':1,'seconds':t_newZ}}
+    total = t_x+t_new+t_newZ
+    return {'sweep':'reshape','points':n,'seconds':total,'points_per_s':n/total,
+            'breakdown':breakdown,'writes_saved':{}}
+
+def benchCube(num_files=16,num_x=400,num_y=200):
+    """
+    loadCube of a B sweep with one process against all cores
+    """
+    import os, tempfile, shutil
+    import RU_plot, RU_io
+    fdir = tempfile.mkdtemp()
+    saved = RU_io.sidecarDir
+    RU_io.sidecarDir = fdir+'/cache' # keep the files themselves uncached
+    os.mkdir(RU_io.sidecarDir)
+    try:
+        x = np.linspace(4e9,7e9,num_x)
+        y = np.linspace(-40,0,num_y)
+        entries = []
+        for i in range(num_files):
+            fname = os.path.join(fdir,'TWPA_B=%duA_20170101%06d.dat' % (i,i))
+            data = np.column_stack((np.tile(x,num_y),np.repeat(y,num_x),np.random.rand(num_x*num_y)))
+            with open(fname,'w') as fh:
+                fh.write('#SignalFreq(Hz)\tSignalPow(dBm)\tMag(dB)\n#Data starts from here :\n')
+            with open(fname,'ab') as fh:
+                np.savetxt(fh,data,delimiter='\t')
+            entries.append([i,fname])
+        breakdown = {}
+        with quiet():
+            for processes in (1,os.cpu_count()):
+                for f in os.listdir(RU_io.sidecarDir):
+                    os.remove(os.path.join(RU_io.sidecarDir,f))
+                t0 = time.time()
+                with RU_plot.tempCube(entries,'Mag(dB)','SignalFreq(Hz)','SignalPow(dBm)',processes):
+                    t = time.time()-t0
+                breakdown['%d processes' % processes] = {'calls':1,'seconds':t}
+    finally:
+        RU_io.sidecarDir = saved
+        shutil.rmtree(fdir)
+    n = num_files*num_x*num_y
+    return {'sweep':'cube','points':n,'seconds':t,'points_per_s':n/t,
+            'breakdown':breakdown,'writes_saved':{}}
+
+analysisBenchmarks = [benchReshape,benchCube]
+
+#############################################################################
+        #Import time
+
+IMPORT_LIMIT = 0.1 # seconds
+
+_importScript = """
+import sys, time, json
+t0 = time.perf_counter()
+import RU_meas
+t = time.perf_counter()-t0
+heavy = ['numpy','matplotlib','visa','win32com','ctypes']
+print(json.dumps([t,[m for m in heavy if m in sys.modules]]))
+"""
+
+def benchImport(repeat=5):
+    """
+    import RU_meas in fresh interpreters, fastest of repeat runs.
+    ok is False when it takes longer than IMPORT_LIMIT or loads a heavy
+    module (numpy, matplotlib, visa, win32com, ctypes)
+    """
+    import os
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable,'-c',_importScript],cwd=here)
+        t,loaded = json.loads(out.decode().strip().splitlines()[-1])
+        times.append(t)
+    t = min(times)
+    return {'sweep':'import','points':1,'seconds':t,'points_per_s':1/t,
+            'breakdown':{'loaded: %s' % (', '.join(loaded) or 'nothing heavy'):{'calls':repeat,'seconds':t}},
+            'writes_saved':{},'ok':t < IMPORT_LIMIT and not loaded}
+
+def report(results):
+    lines = []
+    for r in results:
+        lines.append("%-6s %5d points %8.3f s %8.2f points/s" % (r['sweep'],r['points'],r['seconds'],r['points_per_s']))
+        for instr,b in r['breakdown'].items():
+            lines.append("       %-22s %6d calls %8.3f s %5.1f %%" % (instr,b['calls'],b['seconds'],100*b['seconds']/r['seconds']))
+        for instr,saved in r['writes_saved'].items():
+            lines.append("       %-22s %6d writes saved by cache" % (instr,saved))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points',type=int,default=10)
+    parser.add_argument('--latency',type=float,default=0.002,help='seconds per simulated bus transaction')
+    parser.add_argument('--ats-latency',type=float,default=0.02,help='seconds per simulated ATS VI call')
+    parser.add_argument('--json',default=None,help='write results to this file')
+    parser.add_argument('--analysis',action='store_true',help='run the RU_plot benchmarks instead')
+    parser.add_argument('--budget',action='store_true',help='print the RU_profile time budget of each sweep')
+    args = parser.parse_args(argv)
+
+    results = [benchImport()]
+    if args.analysis:
+        for bench in analysisBenchmarks:
+            results.append(bench())
+    else:
+        for bench in benchmarks:
+            backend = RU_sim.install(args.latency,ATS_spec=args.ats_latency)
+            if args.budget:
+                RU_profile.start()
+            results.append(bench(backend,args.points))
+            if args.budget:
+                print(RU_profile.stop().report())
+    print(report(results))
+    if args.json:
+        with open(args.json,'w') as fh:
+            json.dump(results,fh,indent=1)
+    if not results[0]['ok']:
+        print("FAIL: importing RU_meas takes %.3f s or loads heavy modules" % results[0]['seconds'])
+    return results
+
+if __name__ =="__main__":
+    sys.exit(0 if main()[0]['ok'] else 1)
@@ -0,0 +1,160 @@
+"""
+Calibration tables of the attenuator bank. The loss of each
+(channel, attenuation, frequency) point is measured once with the power
+meter, kept on disk and interpolated afterwards, so sweeps get calibrated
+power without touching the meter.
+
+    cal = CalTable('aeroflex_cal.json')
+    cal.calibrate(attBank,powerMeter,SGEN1,1,np.arange(0,64,2),np.arange(4,8.1,0.5))
+    attBank.cal = cal
+    attBank.BalAtten(20,freq=5.2)      # calibrated 20 dB on channel 1, balanced on channel 2
+    cal.power(1,20,5.2,inputPower=-20) # dBm after channel 1
+"""
+
+import os, time, json
+import numpy as np
+
+class CalTable(object):
+    """
+    fname: JSON file the table is kept in, loaded if it exists
+    maxAge: seconds after which a point is stale and measured again
+    """
+    version = 1
+
+    def __init__(self,fname=None,maxAge=30*86400):
+        self.fname = fname
+        self.maxAge = maxAge
+        self.points = {} # (chan,atten,freq): (loss,time)
+        self._grids = {}
+        if fname is not None and os.path.exists(fname):
+            self.load()
+
+    def load(self):
+        with open(self.fname,'r') as fh:
+            saved = json.load(fh)
+        if saved.get('version') != self.version:
+            print("ERROR: %s has calibration format %s" % (self.fname,saved.get('version')))
+            return
+        self.points = dict(((int(c),float(a),float(f)),(loss,t)) for c,a,f,loss,t in saved['points'])
+        self._grids = {}
+
+    def save(self):
+        points = [[c,a,f,loss,t] for (c,a,f),(loss,t) in sorted(self.points.items())]
+        with open(self.fname+'.tmp','w') as fh:
+            json.dump({'version':self.version,'points':points},fh)
+        os.replace(self.fname+'.tmp',self.fname)
+
+    def add(self,chan,atten,freq,loss,t=None):
+        self.points[(int(chan),float(atten),float(freq))] = (float(loss),t or time.time())
+        self._grids.pop(int(chan),None)
+
+    def calibrated(self,chan):
+        """
+        True if the table has points of the channel
+        """
+        try:
+            self._grid(chan)
+            return True
+        except KeyError:
+            return False
+
+    def stale(self,chan,atten,freq):
+        """
+        return the (atten,freq) pairs of the grid that are missing or older
+        than maxAge
+        """
+        now = time.time()
+        missing = []
+        for f in np.atleast_1d(freq):
+            for a in np.atleast_1d(atten):
+                point = self.points.get((int(chan),float(a),float(f)))
+                if point is None or now-point[1] > self.maxAge:
+                    missing.append((float(a),float(f)))
+        return missing
+
+    def calibrate(self,attBank,powerMeter,source,chan,atten,freq,inputPower=-20,wait=4.0):
+        """
+        measure the stale points of the atten x freq grid of one channel:
+        the source feeds inputPower through the channel into the power
+        meter, loss = inputPower - reading. wait: seconds for the meter to
+        settle after each change. return number of points measured.
+        """
+        missing = self.stale(chan,atten,freq)
+        print("Calibrating %d of %d points of channel %d" % (len(missing),np.size(atten)*np.size(freq),chan))
+        currentFreq = None
+        for a,f in missing: # grouped by frequency
+            if f != currentFreq:
+                source.setFreqPow(f,inputPower)
+                currentFreq = f
+            attBank.setAtten(chan,a)
+            time.sleep(wait)
+            self.add(chan,a,f,inputPower-float(powerMeter.readPower()))
+        if missing and self.fname is not None:
+            self.save()
+        return len(missing)
+
+    def _grid(self,chan):
+        """
+        sorted frequencies of a channel and, per frequency, the sorted
+        attenuations measured there with their losses
+        """
+        if chan not in self._grids:
+            keys = sorted(k for k in self.points if k[0] == chan)
+            if not keys:
+                raise KeyError("channel %d is not calibrated" % chan)
+            F = np.unique([k[2] for k in keys])
+            columns = []
+            for f in F:
+                column = sorted((k[1],self.points[k][0]) for k in keys if k[2] == f)
+                columns.append((np.array([c[0] for c in column]),np.array([c[1] for c in column])))
+            A = np.unique([k[1] for k in keys])
+            self._grids[chan] = (A,F,columns)
+        return self._grids[chan]
+
+    def loss(self,chan,atten,freq):
+        """
+        loss (dB) of a channel at a nominal attenuation and frequency,
+        linear between calibrated points, flat outside them
+        """
+        A,F,columns = self._grid(chan)
+        j0,j1,v = _bracket(F,freq)
+        losses = []
+        for j in (j0,j1):
+            Aj,Lj = columns[j]
+            i0,i1,u = _bracket(Aj,atten)
+            losses.append((1-u)*Lj[i0]+u*Lj[i1])
+        return (1-v)*losses[0]+v*losses[1]
+
+    def power(self,chan,atten,freq,inputPower):
+        """
+        calibrated power (dBm) after the channel
+        """
+        return inputPower-self.loss(chan,atten,freq)
+
+    def setting(self,chan,loss,freq):
+        """
+        calibrated attenuation closest to a wanted loss at freq, by
+        bisection over the (monotonic) calibrated losses
+        """
+        A = self._grid(chan)[0]
+        lo,hi = 0,A.size-1
+        while hi-lo > 1:
+            mid = (lo+hi)//2
+            if self.loss(chan,A[mid],freq) < loss:
+                lo = mid
+            else:
+                hi = mid
+        if abs(self.loss(chan,A[lo],freq)-loss) <= abs(self.loss(chan,A[hi],freq)-loss):
+            return A[lo]
+        return A[hi]
+
+def _bracket(grid,value):
+    """
+    neighbouring indices of value in a sorted grid and the weight of the upper one
+    """
+    if grid.size == 1 or value <= grid[0]:
+        return 0,0,0.0
+    if value >= grid[-1]:
+        return grid.size-1,grid.size-1,0.0
+    i = np.searchsorted(grid,value)
+    return i-1,i,(value-grid[i-1])/(grid[i]-grid[i-1])
@@ -0,0 +1,156 @@
+"""
+Fit a model to every trace of a map, e.g. the resonance of each B field or
+the gain curve of each signal frequency.
+Models have analytic Jacobians, each trace starts from the result of its
+neighbour and chunks of traces are spread over a process pool.
+
+    result = fitData(Lorentzian(),TWPAdata(fname),'Mag(dB)')
+    pcolor(result['f0'])
+"""
+
+import os
+import numpy as np
+import concurrent.futures
+from scipy.optimize import curve_fit
+
+LN10 = np.log(10)
+
+class Model(object):
+    """
+    params: names of the parameters
+    f(x,*p): model, jac(x,*p): (x.size, len(params)) Jacobian,
+    guess(x,y): starting parameters of a trace
+    """
+    params = []
+
+    def f(self,x,*p):
+        raise NotImplementedError
+
+    def jac(self,x,*p):
+        raise NotImplementedError
+
+    def guess(self,x,y):
+        raise NotImplementedError
+
+class Lorentzian(Model):
+    """
+    resonance peak or dip: offset + A/(1+((x-x0)/gamma)**2)
+    gamma is the half width at half maximum
+    """
+    params = ['f0','gamma','A','offset']
+
+    def f(self,x,f0,gamma,A,offset):
+        return offset+A/(1+((x-f0)/gamma)**2)
+
+    def jac(self,x,f0,gamma,A,offset):
+        u = (x-f0)/gamma
+        L = 1/(1+u**2)
+        dL = 2*A*u*L**2/gamma # d(A*L)/df0, d/dgamma is this times u
+        return np.column_stack((dL,dL*u,L,np.ones_like(x)))
+
+    def guess(self,x,y):
+        offset = np.median(y)
+        i = np.argmax(np.abs(y-offset))
+        A = y[i]-offset
+        half = np.abs(y-offset) > np.abs(A)/2
+        gamma = max(np.count_nonzero(half),1)*np.abs(x[1]-x[0])/2
+        return [x[i],gamma,A,offset]
+
+class GainCurve(Model):
+    """
+    parametric gain against pump power P(dBm):
+    G(dB) = 20*log10(cosh(k*10**(P/10))) + offset
+    """
+    params = ['k','offset']
+
+    def f(self,P,k,offset):
+        return 20*np.log10(np.cosh(k*10**(P/10)))+offset
+
+    def jac(self,P,k,offset):
+        p = 10**(P/10)
+        return np.column_stack((20/LN10*np.tanh(k*p)*p,np.ones_like(P)))
+
+    def guess(self,P,G):
+        offset = G[np.argmin(P)]
+        i = np.argmax(P)
+        x = np.arccosh(10**(max(G[i]-offset,1e-3)/20))
+        return [x/10**(P[i]/10),offset]
+
+def fitTraces(model,x,traces,warm=True):
+    """
+    fit the traces in order, each starting from the previous result
+    return parameters, standard errors and success flags
+    """
+    n = len(model.params)
+    params = np.full((len(traces),n),np.nan)
+    errors = np.full((len(traces),n),np.nan)
+    success = np.zeros(len(traces),dtype=bool)
+    p0 = None
+    for i,y in enumerate(traces):
+        good = np.isfinite(y)
+        if np.count_nonzero(good) <= n:
+            p0 = None
+            continue
+        xi,yi = x[good],y[good]
+        try:
+            popt,pcov = curve_fit(model.f,xi,yi,p0 if p0 is not None else model.guess(xi,yi),jac=model.jac)
+        except (RuntimeError,ValueError):
+            if p0 is None:
+                continue
+            # the neighbour was a bad start, try again from scratch
+            try:
+                popt,pcov = curve_fit(model.f,xi,yi,model.guess(xi,yi),jac=model.jac)
+            except (RuntimeError,ValueError):
+                p0 = None
+                continue
+        params[i] = popt
+        errors[i] = np.sqrt(np.abs(np.diag(pcov)))
+        success[i] = np.all(np.isfinite(errors[i]))
+        p0 = popt if warm and success[i] else None
+    return params,errors,success
+
+def _fitChunk(task):
+    return fitTraces(*task)
+
+def fitMap(model,x,traces,processes=None,chunk=None,warm=True):
+    """
+    fit every row of traces (num_traces, x.size) against x
+    processes: worker processes, 1 fits in this process
+    chunk: traces per task, neighbouring traces stay in one chunk for the
+    warm start
+    return parameters and errors (num_traces, num_params), success flags
+    """
+    x = np.asarray(x,dtype=float)
+    traces = np.asarray(traces,dtype=float)
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(traces) < 2:
+        return fitTraces(model,x,traces,warm)
+    chunk = chunk or max(1,int(np.ceil(len(traces)/(4.0*processes))))
+    tasks = [(model,x,traces[i:i+chunk],warm) for i in range(0,len(traces),chunk)]
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        results = list(pool.map(_fitChunk,tasks))
+    return (np.vstack([r[0] for r in results]),np.vstack([r[1] for r in results]),
+            np.concatenate([r[2] for r in results]))
+
+def fitData(model,data,zlabel=None,along='x',**kwargs):
+    """
+    fit every trace of a TWPAdata (with zlabel) or dataXYZ map
+    along: 'x' fits Z against X for each Y, 'y' against Y for each X
+    **kwargs: passed to fitMap
+    return {parameter: map, parameter+'_err': map, 'success': map}, one
+    value per trace
+    """
+    if zlabel is not None:
+        Z = np.transpose(data.to2DZ(zlabel)) # TWPAdata maps are (X,Y)
+    else:
+        Z = np.asarray(data.Z)
+    if along == 'x':
+        x,traces = data.X,Z
+    else:
+        x,traces = data.Y,np.transpose(Z)
+    params,errors,success = fitMap(model,x,traces,**kwargs)
+    result = {'success':success}
+    for i,name in enumerate(model.params):
+        result[name] = params[:,i]
+        result[name+'_err'] = errors[:,i]
+    return result
@@ -0,0 +1,500 @@
+"""
+Data file formats: chunked binary files for streaming acquisition, a
+fast reader for the tab separated .dat files with a binary sidecar cache
+and a metadata index of data directories.
+
+Layout of a .rdat file:
+    magic b'RUDAT1\n', uint64 length of the JSON header, JSON header
+    {"labels": [...], "header": text header, "num_cols": n, optional "grid"
+    of a RU_sweep.Sweep}, then chunks of
+    uint64 number of rows followed by the rows stored column by column as
+    little-endian float64.
+A chunk is written and fsync'ed in one go, a chunk cut short by a crash is
+ignored when reading, so at most the rows of one chunk are lost.
+"""
+
+import os, re, json, time, struct, bisect, fnmatch
+import numpy as np
+import RU_profile
+
+MAGIC = b'RUDAT1\n'
+_count = struct.Struct('<Q')
+
+def _labels(header):
+    """
+    column labels of a spectroscopy_File_Header style header
+    """
+    return header.labels.lstrip('#').split('\t')
+
+class StreamWriter(object):
+    """
+    Append rows to a .rdat file, flushed every chunkRows rows or every
+    flushInterval seconds.
+        writer = StreamWriter(fname,spectroscopy_File_Header(...))
+        writer.append([T1,T2,freq,mag,phase,...])
+        writer.close()
+        toDat(fname,fname[:-5]+'.dat')
+    header: object with labels and header(), or None to append to an
+    existing file.
+    end: file offset to append at, later chunks are dropped (see self.end)
+    """
+    def __init__(self,fname,header=None,chunkRows=1000,flushInterval=10.0,end=None):
+        self.fname = fname
+        self.chunkRows = chunkRows
+        self.flushInterval = flushInterval
+        if header is None:
+            meta,chunks,last = _scan(fname)
+            if end is None or end > last:
+                end = last
+            self.fh = open(fname,'r+b')
+            self.fh.truncate(end) # drop a chunk cut short by a crash
+            self.fh.seek(end)
+        else:
+            meta = {'labels':_labels(header),'header':header.header()}
+            meta['num_cols'] = len(meta['labels'])
+            if hasattr(header,'grid'):
+                meta['grid'] = header.grid()
+            text = json.dumps(meta).encode()
+            self.fh = open(fname,'wb')
+            self.fh.write(MAGIC+_count.pack(len(text))+text)
+            self._sync()
+            end = self.fh.tell()
+        # offset after the last chunk on disk
+        self.end = end
+        self.labels = meta['labels']
+        self.num_cols = meta['num_cols']
+        self.buffer = np.empty((chunkRows,self.num_cols))
+        self.num_buffered = 0
+        self.num_rows = 0
+        self.lastFlush = time.time()
+
+    def _write(self,data):
+        self.fh.write(data)
+        self._sync()
+
+    def _sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def append(self,row):
+        self.buffer[self.num_buffered] = row
+        self.num_buffered += 1
+        self.num_rows += 1
+        if self.num_buffered == self.chunkRows or time.time()-self.lastFlush > self.flushInterval:
+            self.flush()
+
+    def appendRows(self,rows):
+        for row in np.atleast_2d(rows):
+            self.append(row)
+
+    def flush(self):
+        """
+        write the buffered rows as one chunk
+        """
+        if self.num_buffered:
+            chunk = self.buffer[:self.num_buffered]
+            data = _count.pack(self.num_buffered)+np.asfortranarray(chunk,dtype='<f8').tobytes(order='F')
+            RU_profile.timed('StreamWriter','flush',self._write,data)
+            self.end = self.fh.tell()
+            self.num_buffered = 0
+        self.lastFlush = time.time()
+
+    def close(self):
+        if not self.fh.closed:
+            self.flush()
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def readMeta(fname):
+    """
+    return the JSON header and the file offset of the first chunk
+    """
+    with open(fname,'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a RUDAT file" % fname)
+        length = _count.unpack(fh.read(_count.size))[0]
+        meta = json.loads(fh.read(length).decode())
+    return meta,len(MAGIC)+_count.size+length
+
+def _scan(fname):
+    """
+    return JSON header, list of chunks and the end offset of the last whole chunk
+    """
+    meta,offset = readMeta(fname)
+    num_cols = meta['num_cols']
+    with open(fname,'rb') as fh:
+        raw = fh.read()
+    chunks = []
+    while offset+_count.size <= len(raw):
+        rows = _count.unpack_from(raw,offset)[0]
+        end = offset+_count.size+8*rows*num_cols
+        if end > len(raw):
+            break # chunk cut short by a crash
+        chunk = np.frombuffer(raw,'<f8',rows*num_cols,offset+_count.size)
+        chunks.append(chunk.reshape((num_cols,rows)).T)
+        offset = end
+    return meta,chunks,offset
+
+def readStream(fname):
+    """
+    return JSON header and data rows of a .rdat file, rows of a sweep in
+    grid order whatever order they were measured in
+    """
+    meta,chunks,end = _scan(fname)
+    num_cols = meta['num_cols']
+    if chunks:
+        data = np.vstack(chunks)
+    else:
+        data = np.empty((0,num_cols))
+    if meta.get('grid',{}).get('serpentine'):
+        data = _gridOrdered(meta['grid'],data)
+    return meta,data
+
+def gridOrder(sizes,serpentine=False,num=None):
+    """
+    grid indices of the first num points of a walk over a grid of sizes,
+    outermost first, as a (num, len(sizes)) array. serpentine: an index
+    runs backward when the indices outside it have advanced an odd number
+    of times (reflected mixed radix), so consecutive points differ in one.
+    """
+    sizes = np.asarray(sizes,dtype=np.int64)
+    k = np.arange(int(np.prod(sizes)) if num is None else num,dtype=np.int64)
+    blocks = np.append(np.cumprod(sizes[::-1])[::-1][1:],1)
+    digits = k[:,None]//blocks % sizes
+    if serpentine:
+        outer = k[:,None]//(blocks*sizes)
+        digits = np.where(outer % 2,sizes-1-digits,digits)
+    return digits
+
+def _gridOrdered(grid,data):
+    """
+    rows of a sweep walk sorted into grid order. A point is a run of rows
+    with the same axis values, so points may have different numbers of rows
+    (e.g. adaptive traces); the values of an axis must be distinct.
+    """
+    if data.shape[0] == 0:
+        return data
+    axes = data[:,grid['columns']]
+    starts = np.append(0,np.flatnonzero(np.any(axes[1:] != axes[:-1],axis=1))+1)
+    ends = np.append(starts[1:],data.shape[0])
+    index = gridOrder(grid['sizes'],grid['serpentine'],starts.size)
+    order = np.argsort(np.ravel_multi_index(index.T,grid['sizes']),kind='stable')
+    return np.concatenate([data[starts[i]:ends[i]] for i in order])
+
+def toDat(fname,datname):
+    """
+    export a .rdat file to the tab separated text layout read by RU_plot.dfile
+    """
+    meta,data = readStream(fname)
+    with open(datname,'w') as fh:
+        fh.write(meta['header'])
+    with open(datname,'ab') as fh:
+        np.savetxt(fh,data,delimiter='\t')
+
+#############################################################################
+        #Text .dat files
+
+# directory for sidecar caches of .dat files, None keeps them next to the
+# file as hidden files, which FileIndex skips
+sidecarDir = None
+
+def readDat(fname):
+    """
+    read a .dat file in one pass
+    return list of '#' header lines and the data rows as 2-D array
+    """
+    with open(fname,'r') as fh:
+        text = fh.read()
+    header = []
+    pos = 0
+    while text.startswith('#',pos):
+        end = text.find('\n',pos)
+        end = len(text) if end < 0 else end+1
+        header.append(text[pos:end])
+        pos = end
+    end = text.find('\n',pos)
+    num_cols = len(text[pos:end if end >= 0 else len(text)].split())
+    # fromstring stops at or raises on anything it cannot parse, e.g. a '#'
+    # line further down, so the values must fill every line
+    num_rows = text.count('\n',pos)+(not text.endswith('\n'))
+    try:
+        data = np.fromstring(text[pos:],sep=' ')
+    except ValueError:
+        data = None
+    if num_cols == 0 or data is None or data.size != num_rows*num_cols:
+        data = np.loadtxt(fname,ndmin=2)
+    else:
+        data = data.reshape((-1,num_cols))
+    return header,data
+
+def _sidecar(fname):
+    if sidecarDir is None:
+        fdir,name = os.path.split(fname)
+        return os.path.join(fdir,'.'+name+'.cache')
+    return os.path.join(sidecarDir,os.path.basename(fname)+'.cache')
+
+def loadSidecar(fname):
+    """
+    return header lines and memory-mapped data of the sidecar cache of a
+    .dat file, None if there is none or the file changed since
+    """
+    base = _sidecar(fname)
+    try:
+        with open(base+'.json','r') as fh:
+            meta = json.load(fh)
+        stat = os.stat(fname)
+        if meta['mtime'] != stat.st_mtime or meta['size'] != stat.st_size:
+            return None
+        # copy on write: callers may correct data in place
+        data = np.load(base+'.npy',mmap_mode='c')
+    except (IOError,OSError,ValueError,KeyError):
+        return None
+    return meta['header'],data
+
+def saveSidecar(fname,header,data):
+    """
+    write the binary sidecar cache of a .dat file, the json is written
+    last and marks the cache valid
+    """
+    base = _sidecar(fname)
+    try:
+        stat = os.stat(fname)
+        np.save(base+'.npy',np.ascontiguousarray(data))
+        with open(base+'.json','w') as fh:
+            json.dump({'mtime':stat.st_mtime,'size':stat.st_size,'header':header},fh)
+    except (IOError,OSError) as e:
+        print("Cannot write cache of %s: %s" % (fname,e))
+
+#############################################################################
+        #Binary X,Y,Z maps
+
+def saveXYZ(dirname,X,Y,Z,header='',labels=None):
+    """
+    save a map as directory dirname (e.g. 'map.xyz') holding X.npy, Y.npy,
+    Z.npy (Y rows, X columns) and meta.json with the text header and labels.
+    meta.json is written last and marks the map complete.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    meta = os.path.join(dirname,'meta.json')
+    if os.path.exists(meta):
+        os.remove(meta)
+    np.save(os.path.join(dirname,'X.npy'),np.asarray(X,dtype=float))
+    np.save(os.path.join(dirname,'Y.npy'),np.asarray(Y,dtype=float))
+    np.save(os.path.join(dirname,'Z.npy'),np.ascontiguousarray(Z,dtype=float))
+    with open(meta,'w') as fh:
+        json.dump({'header':header,'labels':labels or {},'shape':list(np.shape(Z))},fh)
+
+def loadXYZ(dirname,mmap_mode='c'):
+    """
+    return X, Y, Z and the meta dictionary of a map saved by saveXYZ.
+    Z is memory-mapped, only the slices used are read from disk; the
+    default copy on write mode lets callers change values without touching
+    the file.
+    """
+    with open(os.path.join(dirname,'meta.json'),'r') as fh:
+        meta = json.load(fh)
+    X = np.load(os.path.join(dirname,'X.npy'))
+    Y = np.load(os.path.join(dirname,'Y.npy'))
+    Z = np.load(os.path.join(dirname,'Z.npy'),mmap_mode=mmap_mode)
+    return X,Y,Z,meta
+
+def xyzToBinary(fname,dirname):
+    """
+    convert a dataXYZ text file (X in the first row, Y in the first column)
+    to the binary layout of saveXYZ
+    """
+    header,data = readDat(fname)
+    labels = {}
+    for line in header:
+        m = re.match(r'#\s*([XYZ])\s*:(.*)',line)
+        if m:
+            labels[m.group(1).lower()] = m.group(2).strip()
+    saveXYZ(dirname,data[0,1:],data[1:,0],data[1:,1:],''.join(header),labels)
+
+def xyzToText(dirname,fname):
+    """
+    convert a binary map of saveXYZ to the dataXYZ text layout
+    """
+    X,Y,Z,meta = loadXYZ(dirname,'r')
+    header = meta['header']
+    if header and not header.endswith('\n'):
+        header += '\n'
+    with open(fname,'w') as fh:
+        fh.write(header)
+    with open(fname,'ab') as fh:
+        np.savetxt(fh,np.hstack(([0.0],X))[np.newaxis,:],delimiter='\t')
+        for i in range(0,Y.size,1000):
+            rows = np.column_stack((Y[i:i+1000],Z[i:i+1000]))
+            np.savetxt(fh,rows,delimiter='\t')
+
+#############################################################################
+        #Directory index
+
+def parseFileName(name):
+    """
+    return timestamp, B field and key=value tokens of a data file name like
+    TWPA_S21GAIN_pumpFreq=5200MHz_B=240uA_20161229230459[_PumpON].dat
+    """
+    stamps = re.findall(r'(?<!\d)\d{14}(?!\d)',name)
+    timestamp = int(stamps[-1]) if stamps else None
+    params = {}
+    for token in os.path.splitext(name)[0].split('_'):
+        if '=' in token:
+            key,value = token.split('=',1)
+            params[key] = value
+    B = None
+    if 'B' in params:
+        B = _number(params['B'])
+    if B is None:
+        numbers = re.findall(r'[+-]?\d+',name)
+        if len(numbers) >= 2:
+            B = float(numbers[-2])
+    return timestamp,B,params
+
+def _number(value):
+    """
+    leading number of a token value, '5200MHz' gives 5200.0
+    """
+    m = re.match(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?',value)
+    return float(m.group(0)) if m else None
+
+def _labels_of(path):
+    try:
+        with open(path,'r') as fh:
+            line = fh.readline()
+    except (IOError,OSError,UnicodeDecodeError):
+        return []
+    return line[1:].split() if line.startswith('#') else []
+
+class FileIndex(object):
+    """
+    Metadata of the data files of a directory kept on disk, updated only
+    when the directory modification time changes. All files matching
+    pattern are indexed, query narrows them down by name.
+        index = FileIndex(fdir)
+        index.query('*GAIN*',timestamp=(20161229000000,20161230000000),
+                    B=(0,300),pumpFreq=5200)
+    Each entry holds name, timestamp, B, params (key=value tokens of the
+    name), values (their leading numbers) and the header labels.
+    """
+    version = 1
+
+    def __init__(self,fdir,pattern='*',fname=None):
+        self.fdir = fdir
+        self.pattern = pattern
+        self.fname = fname or os.path.join(fdir,'.RU_index.json')
+        self.entries = {}
+        self.mtime = None
+        self.load()
+        self.update()
+
+    def load(self):
+        try:
+            with open(self.fname,'r') as fh:
+                saved = json.load(fh)
+        except (IOError,OSError,ValueError):
+            return
+        if saved.get('version') == self.version and saved.get('pattern') == self.pattern:
+            self.entries = saved['entries']
+            self.mtime = saved['mtime']
+            self._sort()
+
+    def save(self):
+        # rewritten in place: creating or renaming a file would change the
+        # directory mtime the index is keyed on. A broken file is rebuilt.
+        try:
+            with open(self.fname,'w') as fh:
+                json.dump({'version':self.version,'pattern':self.pattern,
+                           'mtime':self.mtime,'entries':self.entries},fh)
+        except (IOError,OSError) as e:
+            print("Cannot save index of %s: %s" % (self.fdir,e))
+
+    def update(self):
+        """
+        rescan the directory if it changed, parse only new files.
+        return True if the index changed
+        """
+        if not os.path.exists(self.fname):
+            try:
+                open(self.fname,'a').close()
+            except (IOError,OSError):
+                pass
+        mtime = os.stat(self.fdir).st_mtime
+        if mtime == self.mtime:
+            return False
+        names = set(name for name in fnmatch.filter(os.listdir(self.fdir),self.pattern) if _isData(name))
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+        for name in names-set(self.entries):
+            timestamp,B,params = parseFileName(name)
+            values = dict((k,_number(v)) for k,v in params.items())
+            self.entries[name] = {'name':name,'timestamp':timestamp,'B':B,'params':params,
+                                  'values':values,'labels':_labels_of(os.path.join(self.fdir,name))}
+        self.mtime = mtime
+        self._sort()
+        self.save()
+        return True
+
+    def _sort(self):
+        dated = [e for e in self.entries.values() if e['timestamp'] is not None]
+        dated.sort(key=lambda e:e['timestamp'])
+        self._dated = dated
+        self._times = [e['timestamp'] for e in dated]
+
+    def query(self,matchKey='*',timestamp=None,B=None,**params):
+        """
+        return entries matching the file name pattern and the criteria.
+        A criterion is a value or an inclusive (low,high) range; params are
+        compared with the leading number of the key=value token of the name.
+        """
+        if timestamp is not None:
+            low,high = _range(timestamp)
+            candidates = self._dated[bisect.bisect_left(self._times,low):bisect.bisect_right(self._times,high)]
+        else:
+            candidates = list(self.entries.values())
+        result = []
+        for entry in candidates:
+            if matchKey != '*' and not fnmatch.fnmatch(entry['name'],matchKey):
+                continue
+            if B is not None and not _inRange(entry['B'],B):
+                continue
+            if all(_inRange(entry['values'].get(key),value) for key,value in params.items()):
+                result.append(entry)
+        return result
+
+def _range(criterion):
+    if isinstance(criterion,(tuple,list)):
+        return criterion[0],criterion[-1]
+    return criterion,criterion
+
+def _inRange(value,criterion):
+    if value is None:
+        return False
+    low,high = _range(criterion)
+    return low <= value <= high
+
+def _isData(name):
+    """
+    hidden files, such as the index itself, and sidecar caches are never data
+    """
+    return not (name.startswith('.') or name.endswith('.cache.npy') or name.endswith('.cache.json'))
+
+_indexes = {}
+
+def fileIndex(fdir,pattern='*'):
+    """
+    return the FileIndex of fdir, kept in memory between calls
+    """
+    key = (os.path.abspath(fdir),pattern)
+    if key not in _indexes:
+        _indexes[key] = FileIndex(fdir,pattern)
+    else:
+        _indexes[key].update()
+    return _indexes[key]
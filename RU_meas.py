@@ -3,15 +3,25 @@ This is the python code contains driver for all measurement devices.
 @author: Wenyuan Zhang @ Rutgers GershLab
 """
 
-import sys, os, time, datetime
-import visa
-import win32com.client  # Python ActiveX Client
-import numpy as np
-import ctypes
-import matplotlib.pyplot as plt
-# to use labview program, open all relevant labview before running python
-LabVIEW = win32com.client.Dispatch('LabVIEW.Application') 
-rm = visa.ResourceManager()
+import sys, os, re, time, datetime, threading, contextlib, importlib, itertools
+import RU_profile
+
+class _LazyModule(object):
+    """
+    Import a module on first use and rebind the global name to it, so that
+    importing RU_meas stays fast and has no side effects.
+    """
+    def __init__(self,module,alias):
+        self._module = module
+        self._alias = alias
+
+    def __getattr__(self,attr):
+        module = importlib.import_module(self._module)
+        globals()[self._alias] = module
+        return getattr(module,attr)
+
+np = _LazyModule('numpy','np')
+plt = _LazyModule('matplotlib.pyplot','plt')
 dir_ = "C:\\Google Drive\\Rutgers Qubit Main Share Folder\\_People__Wenyuan\\Python\\" #measurement code directory
 
 def setPlotting(PLOT=True):
@@ -28,45 +38,546 @@ def setPlotting(PLOT=True):
 
 def timestamp():
     return '{:%Y%m%d%H%M%S}'.format(datetime.datetime.now())
+#############################################################################
+        #Backends
+
+class HardwareBackend(object):
+    """
+    Real instruments: LabVIEW through ActiveX and GPIB through VISA.
+    The LabVIEW session and the ResourceManager open on first use.
+    """
+    def __init__(self):
+        self._LabVIEW = None
+        self._rm = None
+
+    @property
+    def LabVIEW(self):
+        if self._LabVIEW is None:
+            import win32com.client  # Python ActiveX Client
+            # to use labview program, open all relevant labview before running python
+            self._LabVIEW = win32com.client.Dispatch('LabVIEW.Application')
+        return self._LabVIEW
+
+    @property
+    def rm(self):
+        if self._rm is None:
+            import visa
+            self._rm = visa.ResourceManager()
+        return self._rm
+
+    def open_resource(self,visaAddress):
+        return self.rm.open_resource(visaAddress)
+
+    def getvireference(self,VIpath):
+        VI = self.LabVIEW.getvireference(VIpath)  # Path to LabVIEW VI
+        VI._FlagAsMethod("Call")  # Flag "Call" as Method
+        VI._FlagAsMethod("Run")
+        VI._FlagAsMethod("Abort")
+        return VI
+
+_backend = None
+
+def getBackend():
+    """
+    return the backend used by instruments, default to real hardware
+    """
+    global _backend
+    if _backend is None:
+        _backend = HardwareBackend()
+    return _backend
+
+def setBackend(backend):
+    """
+    Swap the backend, e.g. RU_sim.SimBackend(), and return the previous one.
+    Instruments pick up the backend when they are initialized.
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    registry.clear()
+    return previous
+
+class SessionRegistry(object):
+    """
+    Process wide cache of VISA sessions and LabVIEW VI references keyed by
+    address or VI path, so re-running a script or creating a driver again
+    reuses open connections. Opening is retried retries times, waiting
+    retryDelay seconds in between, and warm-ups run once per process.
+    The setpoint cache of the instrument state lives here as well, one per
+    address or VI path, so drivers sharing a session see each other's writes.
+    """
+    def __init__(self,retries=2,retryDelay=0.5):
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.sessions = {}
+        self.VIs = {}
+        self.states = {}
+        self.warmedUp = set()
+        self._lock = threading.RLock()
+
+    def _retry(self,what,func,*args):
+        for attempt in range(self.retries+1):
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print("ERROR: %s failed (%s), retrying" % (what,e))
+                time.sleep(self.retryDelay)
+
+    def isOpen(self,visaAddress):
+        return visaAddress in self.sessions
+
+    def resource(self,visaAddress):
+        """
+        return the session of visaAddress, opened on first request
+        """
+        with self._lock:
+            if visaAddress not in self.sessions:
+                self.sessions[visaAddress] = self._retry("opening %s" % visaAddress,getBackend().open_resource,visaAddress)
+            return self.sessions[visaAddress]
+
+    def reconnect(self,visaAddress):
+        """
+        close and reopen the session of visaAddress, its setpoint cache is
+        dropped since the instrument may have lost its state
+        """
+        with self._lock:
+            self.states.get(visaAddress,{}).clear()
+            handle = self.sessions.pop(visaAddress,None)
+            try:
+                handle.close()
+            except Exception:
+                pass
+            return self.resource(visaAddress)
+
+    def VI(self,VIpath,refresh=False):
+        """
+        return the VI reference of VIpath, refresh gets a new one and drops
+        the setpoint cache of the VI
+        """
+        with self._lock:
+            if refresh:
+                self.states.get(VIpath,{}).clear()
+            if refresh or VIpath not in self.VIs:
+                self.VIs[VIpath] = self._retry("opening %s" % VIpath,getBackend().getvireference,VIpath)
+            return self.VIs[VIpath]
+
+    def state(self,key):
+        """
+        return the setpoint cache shared by all drivers of key
+        """
+        with self._lock:
+            return self.states.setdefault(key,{})
+
+    def warmup(self,key,func,*args):
+        """
+        run func(*args) the first time key is warmed up in this process
+        """
+        with self._lock:
+            if key in self.warmedUp:
+                return False
+            func(*args)
+            self.warmedUp.add(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            for handle in self.sessions.values():
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+            self.sessions = {}
+            self.VIs = {}
+            self.states = {}
+            self.warmedUp = set()
+
+registry = SessionRegistry()
+
+_busLocks = {}
+_busLocksLock = threading.Lock()
+
+def busLock(bus):
+    """
+    return the lock serializing commands on a bus, e.g. 'GPIB0'
+    """
+    with _busLocksLock:
+        if bus not in _busLocks:
+            _busLocks[bus] = threading.RLock()
+        return _busLocks[bus]
+
+# settles requested inside applySetpoints are collected here instead of waited
+_local = threading.local()
+
 #############################################################################
         #Instuments 
+
+class SettleProfile(object):
+    """
+    How long an instrument needs after a setting before it is ready.
+    minimum: seconds always waited
+    timeout: stop polling after this many seconds
+    query: VISA query answering non-zero when ready, e.g. '*OPC?'
+    indicator: LabVIEW indicator that is True when the VI is done
+    interval: seconds between polls
+    """
+    def __init__(self,minimum=0.0,timeout=1.0,query=None,indicator=None,interval=0.01):
+        self.minimum = minimum
+        self.timeout = timeout
+        self.query = query
+        self.indicator = indicator
+        self.interval = interval
+
+class Instrument(object):
+    """
+    Common part of LabVIEW and VISA instruments.
+    """
+    settleProfile = SettleProfile(minimum=0.2,timeout=0.2)
+    bus = None
+
+    def initialize(self,key):
+        """
+        key: address or VI path, drivers of the same key share the cache
+        """
+        self.settleTimes = []
+        self.cache = registry.state(key)
+        self.writesSaved = 0
+
+    def invalidateCache(self):
+        """
+        forget the last known state, e.g. after an error or a manual change
+        """
+        self.cache.clear()
+
+    def setCached(self,key,value,func,*args):
+        """
+        call func(*args) to set key to value, unless the cache knows it is
+        already there. return True if func was called.
+        """
+        if key in self.cache and self.cache[key] == value:
+            self.writesSaved += 1
+            return False
+        self.cache.pop(key,None)
+        func(*args)
+        self.cache[key] = value
+        return True
+
+    def ready(self):
+        return True
+
+    def settle(self):
+        """
+        wait the minimum settle time, then poll until the instrument is
+        ready or the timeout is reached. The time spent is kept in settleTimes.
+        Inside applySetpoints the wait is postponed until all setters are done.
+        """
+        pending = getattr(_local,'pending',None)
+        if pending is not None:
+            pending.append(self)
+            return
+        profile = self.settleProfile
+        t0 = time.time()
+        name = self.__class__.__name__
+        if profile.minimum > 0:
+            RU_profile.timed(name,'settle sleep',time.sleep,profile.minimum)
+        while not self.ready():
+            if time.time()-t0 > profile.timeout:
+                print("WARNING: %s not ready after %.3f s" % (name,profile.timeout))
+                break
+            RU_profile.timed(name,'settle sleep',time.sleep,profile.interval)
+        self.settleTimes.append(time.time()-t0)
+
+    def setSettle(self,**kwargs):
+        """
+        change the settle profile of this instrument only, e.g. setSettle(minimum=0.1)
+        """
+        settings = dict(vars(self.settleProfile))
+        settings.update(kwargs)
+        self.settleProfile = SettleProfile(**settings)
+
+    def settleStats(self):
+        """
+        return number of settles, total, mean and max settle time (s)
+        """
+        t = np.array(self.settleTimes)
+        if t.size == 0:
+            return 0,0.0,0.0,0.0
+        return t.size,t.sum(),t.mean(),t.max()
     
-class labView(object):
+class labView(Instrument):
+    # COM calls into LabVIEW stay in the thread that made the VI reference
+    bus = 'LabVIEW'
     
     def __init__(self):
         self.VI =None
         
     def initialize(self,VIpath):
+        super(labView,self).initialize(VIpath)
         print("initialization %s" % VIpath)
-        self.VI= LabVIEW.getvireference(VIpath)  # Path to LabVIEW VI
-        self.VI._FlagAsMethod("Call")  # Flag "Call" as Method       
+        self.VIpath = VIpath
+        self.VI= registry.VI(VIpath)
+
+    def call(self,paras=None,values=None):
+        """
+        run the VI, the state cache is dropped if the call fails and the
+        call is retried with a new VI reference
+        """
+        for attempt in range(registry.retries+1):
+            try:
+                with busLock(self.bus):
+                    if paras is None:
+                        return RU_profile.timed(self.__class__.__name__,'VI.Call',self.VI.Call)
+                    return RU_profile.timed(self.__class__.__name__,'VI.Call',self.VI.Call,paras,values)
+            except Exception as e:
+                self.invalidateCache()
+                if attempt == registry.retries:
+                    raise
+                print("ERROR: %s call failed (%s), reconnecting" % (self.__class__.__name__,e))
+                time.sleep(registry.retryDelay)
+                try:
+                    self.VI = registry.VI(self.VIpath,refresh=True)
+                except Exception as e:
+                    print("ERROR: cannot reconnect %s: %s" % (self.VIpath,e))
+
+    def ready(self):
+        indicator = self.settleProfile.indicator
+        if indicator is None:
+            return True
+        return bool(self.VI.getcontrolvalue(indicator))
         
-class VisaInstrument(object):    
+class Reply(object):
+    """
+    answer of a query queued in VisaInstrument.batch(), value is filled
+    when the batch is sent
+    """
+    def __init__(self,query):
+        self.query = query
+        self.value = None
+
+    def __str__(self):
+        return str(self.value)
+
+def resolveReply(reply):
+    """
+    return the value of a sent Reply, anything else unchanged
+    """
+    if isinstance(reply,Reply) and reply.value is not None:
+        return reply.value
+    return reply
+
+class VisaInstrument(Instrument):    
+    # joins commands of a batch; ';:' returns to the SCPI root
+    batchSeparator = ';:'
+    errorQuery = 'SYST:ERR?'
+    healthQuery = '*IDN?'
+    _batch = None
+    _batchThread = None
+
     def __init__(self):
         self._name =None
         self._visaAddress = None
         self.handle = None
         
     def initialize(self):
+        super(VisaInstrument,self).initialize(self._visaAddress)
         try:
-            self.handle = rm.open_resource(self._visaAddress)
+            reused = registry.isOpen(self._visaAddress)
+            self.handle = registry.resource(self._visaAddress)
+            if reused and not self.healthy():
+                self.handle = registry.reconnect(self._visaAddress)
         except:
             print("ERROR: Cannot initialize instrument!")
+
+    def healthy(self):
+        """
+        True if the session answers healthQuery
+        """
+        if not self.healthQuery:
+            return True
+        try:
+            with busLock(self.bus):
+                self.handle.ask(self.healthQuery)
+            return True
+        except Exception:
+            return False
             
+    @property
+    def bus(self):
+        """
+        interface board of the address, 'GPIB::12::INSTR' is on 'GPIB0'
+        """
+        m = re.match(r'([A-Za-z]+)(\d*)::',self._visaAddress or '')
+        if m is None:
+            return self._visaAddress
+        return m.group(1).upper()+(m.group(2) or '0')
+
     def getHandle(self):
         return self.handle
     def write(self,string):
-        return self.handle.write(string)
+        if self._batching():
+            self._batch.append((string.strip(),None))
+            return None
+        return self._io('write',string)
     def ask(self,string):
-        return self.handle.ask(string)
+        if self._batching():
+            reply = Reply(string.strip())
+            self._batch.append((reply.query,reply))
+            return reply
+        return self._io('ask',string)
+
+    def _io(self,method,string):
+        """
+        one bus transaction; on failure the state cache is dropped, the
+        session reopened and the transaction retried
+        """
+        for attempt in range(registry.retries+1):
+            try:
+                with busLock(self.bus):
+                    return RU_profile.timed(self.__class__.__name__,method,getattr(self.handle,method),string)
+            except Exception as e:
+                self.invalidateCache()
+                if attempt == registry.retries:
+                    raise
+                print("ERROR: %s %s failed (%s), reconnecting" % (self._name,method,e))
+                time.sleep(registry.retryDelay)
+                try:
+                    self.handle = registry.reconnect(self._visaAddress)
+                except Exception as e:
+                    print("ERROR: cannot reconnect %s: %s" % (self._visaAddress,e))
+
+    def _batching(self):
+        return self._batch is not None and self._batchThread == threading.current_thread()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Send the writes and queries of the block as one message, read all
+        replies in one transaction and check errors once with errorQuery.
+            with PSG.batch():
+                PSG.write("POW:AMPL -10 dBm")
+                power = PSG.ask("POW:AMPL?")
+            print(power.value)
+        A batch inside a batch joins the outer one.
+        """
+        if self._batching():
+            yield
+            return
+        self._batch = []
+        self._batchThread = threading.current_thread()
+        try:
+            yield
+            commands = self._batch
+        finally:
+            self._batch = None
+            self._batchThread = None
+        self._sendBatch(commands)
+
+    def _sendBatch(self,commands):
+        replies = [reply for cmd,reply in commands if reply is not None]
+        message = [cmd for cmd,reply in commands]
+        if self.errorQuery and message:
+            message.append(self.errorQuery)
+        if not message:
+            return
+        # a common command (*OPC?) must not follow a ':', it gets a plain ';'
+        message = ''.join([message[0]]+[(';' if cmd.startswith('*') else self.batchSeparator)+cmd
+                                        for cmd in message[1:]])+"\n"
+        if not (replies or self.errorQuery):
+            self.write(message)
+            return
+        answer = self.ask(message).strip().split(';')
+        for reply,value in zip(replies,answer):
+            reply.value = value
+        if self.errorQuery:
+            error = answer[-1] if len(answer) > len(replies) else ''
+            if not re.match(r'[+]?0\b',error):
+                print("ERROR: %s batch: %s" % (self._name,error))
+                self.invalidateCache()
+
+    def settle(self):
+        """
+        in a batch the ready query rides along with the commands, a SCPI
+        instrument answers *OPC? only after the operations complete
+        """
+        if not self._batching():
+            return super(VisaInstrument,self).settle()
+        if self.settleProfile.query:
+            self.ask(self.settleProfile.query)
+
+    def ready(self):
+        query = self.settleProfile.query
+        if query is None:
+            return True
+        try:
+            return float(self.ask(query).split(';')[-1]) != 0
+        except ValueError:
+            return False
         
+def applySetpoints(setpoints):
+    """
+    Set independent instruments at the same time and wait once for all of them.
+    setpoints: {bound setter: arguments}, e.g.
+        {SGEN1.setFreqPow:(4,15), attBank.BalAtten:10, bias.setB_uA:240}
+    Instruments on different buses are written in parallel, commands on a
+    shared bus stay serialized and setters of one instrument keep their order.
+    The settle waits overlap, so a point costs about the slowest instrument.
+    return {setter: return value}
+    """
+    import concurrent.futures
+    groups = {}
+    for setter,args in setpoints.items():
+        if not isinstance(args,tuple):
+            args = (args,)
+        groups.setdefault(setter.__self__.bus,[]).append((setter,args))
+    pending = []
+    results = {}
+
+    def run(group):
+        _local.pending = pending
+        try:
+            for setter,args in group:
+                results[setter] = setter(*args)
+        finally:
+            _local.pending = None
+
+    COMgroup = groups.pop(labView.bus,[])
+    with concurrent.futures.ThreadPoolExecutor(max(len(groups),1)) as pool:
+        futures = [pool.submit(run,group) for group in groups.values()]
+        run(COMgroup)
+        for future in futures:
+            future.result()
+
+    instruments = []
+    for instr in pending:
+        if instr not in instruments:
+            instruments.append(instr)
+    # polling a LabVIEW indicator is a COM call, keep it in this thread
+    COMsettle = [instr for instr in instruments if isinstance(instr,labView) and instr.settleProfile.indicator]
+    with concurrent.futures.ThreadPoolExecutor(max(len(instruments),1)) as pool:
+        futures = [pool.submit(instr.settle) for instr in instruments if instr not in COMsettle]
+        for instr in COMsettle:
+            instr.settle()
+        for future in futures:
+            future.result()
+    return results
+
 class K2602(labView):
     # if it is local folder please refer to e.g.
     # 'C:\\users\\josh\\desktop\\python.vi')
+    # the VI returns when the current is set and has no done indicator, so
+    # this is a blind wait for the bias line filters. 0.2 s is the old fixed
+    # sleep, lower it with setSettle(minimum=...) once the line is measured.
+    settleProfile = SettleProfile(minimum=0.2,timeout=0.2)
     
-    def __init__(self):
+    def __init__(self,visaAddress=None):
+        """
+        visaAddress: GPIB address of the 2602 itself, e.g. "GPIB::26::INSTR",
+        for ramps run from a script on the instrument (BiasRamp)
+        """
         VIpath = dir_+"K2602A_SetCurrent.vi"
         super(K2602,self).initialize(VIpath)
+        self.tsp = K2602TSP(visaAddress) if visaAddress else None
         #self.setCurrent(1,0,0.001)        
         #self.setCurrent(2,0,0.001)
         
@@ -76,8 +587,8 @@ class K2602(labView):
         """
         paras = ["Channel (1or2)",'Set Current (A)','Range (A)']
         values = [Chan,value,output_range]
-        self.VI.Call(paras,values)
-        time.sleep(0.2)
+        if self.setCached(('current',Chan),(value,output_range),self.call,paras,values):
+            self.settle()
         return True
         
     def setB(self,value):
@@ -100,6 +611,84 @@ class K2602(labView):
     def setB_uA(self,value):
         self.setB(value*1e-6)
 
+    @staticmethod
+    def schedule(B):
+        """
+        channel 1 and channel 2 currents (A) of an array of B values (A),
+        split the way setB does: channel 1 up to 1 mA, the rest on channel 2
+        """
+        B = np.asarray(B,dtype=float)
+        ch1 = np.where(np.abs(B) <= 1e-3,B,np.where(B > 0,1e-3,B+1e-3))
+        return ch1,B-ch1
+
+class K2602TSP(VisaInstrument):
+    """
+    Keithley 2602 addressed directly in its TSP language. Holds a two
+    channel current table as a script, stepped one point per command or
+    walked by the instrument with a dwell time per point.
+    """
+    settleProfile = SettleProfile(minimum=0.0,timeout=1.0,query='*OPC?')
+    errorQuery = None
+    scriptName = 'RUbias'
+    tableLine = 100 # values per line of the uploaded script
+
+    def __init__(self,visaAddress="GPIB::26::INSTR",name="K2602TSP"):
+        self._name = name
+        self._visaAddress = visaAddress
+        print("Initializing with resource %s" % visaAddress)
+        super(K2602TSP,self).initialize()
+
+    def _table(self,name,values):
+        lines = ["%s = {}" % name]
+        for i in range(0,len(values),self.tableLine):
+            chunk = ','.join('%.9e' % v for v in values[i:i+self.tableLine])
+            lines.append("for _,v in ipairs({%s}) do table.insert(%s,v) end" % (chunk,name))
+        return lines
+
+    def loadSchedule(self,ch1,ch2,dwell,output_range=0.001):
+        """
+        upload channel currents (A) and dwell times (s) as one script and
+        run it, which sources the first point with both outputs on
+        """
+        lines = ["loadscript %s" % self.scriptName,
+                 "smua.source.func = smua.OUTPUT_DCAMPS",
+                 "smub.source.func = smub.OUTPUT_DCAMPS",
+                 "smua.source.rangei = %g" % output_range,
+                 "smub.source.rangei = %g" % output_range]
+        lines += self._table('biasA',ch1)+self._table('biasB',ch2)+self._table('biasT',dwell)
+        lines += ["function biasStep(i)",
+                  " smua.source.leveli = biasA[i]",
+                  " smub.source.leveli = biasB[i]",
+                  " biasIndex = i",
+                  "end",
+                  "function biasRun()",
+                  " for i = 1, table.getn(biasA) do",
+                  "  biasStep(i)",
+                  "  delay(biasT[i])",
+                  " end",
+                  "end",
+                  "biasStep(1)",
+                  "smua.source.output = smua.OUTPUT_ON",
+                  "smub.source.output = smub.OUTPUT_ON",
+                  "endscript",
+                  "%s()" % self.scriptName]
+        for line in lines:
+            self.write(line)
+        self.settle()
+
+    def stepSchedule(self,index):
+        """
+        go to point index (from 0) of the loaded table
+        """
+        self.write("biasStep(%d)" % (index+1))
+        self.settle()
+
+    def runSchedule(self):
+        """
+        walk the whole table on the instrument, returns at once
+        """
+        self.write("biasRun()")
+
 class Gigatronics(labView):
     def __init__(self,address):
         self.address = address
@@ -110,9 +699,15 @@ class Gigatronics(labView):
     def setFreqPow(self,freq,power):
         paras = ["GPIB Address","Frequency (GHz)","Power (dBm)"]
         values = [self.address,freq,power]
-        self.VI.Call(paras,values)
+        # the VI is shared by all sources, the GPIB address tells them apart
+        self.setCached(('freqpow',self.address),(freq,power),self.call,paras,values)
 
 class LakeShore(VisaInstrument):
+    # blind spacing between queries, the old fixed 0.1 s until measured
+    settleProfile = SettleProfile(minimum=0.1,timeout=0.1)
+    batchSeparator = ';'
+    errorQuery = None
+
     def __init__(self,visaAddress = "GPIB::12::INSTR",name = "LakeShore"):
 
         self._name = name
@@ -132,14 +727,115 @@ class LakeShore(VisaInstrument):
         """
         Temp = self.ask("RDGK? %d \n\r" % Chan)
         Temp = float(Temp.split()[0])
-        time.sleep(0.1)
+        self.settle()
         Resistance = self.ask("RDGR? %d \n\r" % Chan)
         Resistance = float(Resistance.split()[0])
-        time.sleep(0.1)
+        self.settle()
         return Temp,Resistance
 
+    def readTemps(self,Chans):
+        """
+        read several channels in one message
+        return array of Temperature(K) and array of Resistance(Ohm)
+        """
+        query = ';'.join("RDGK? %d;RDGR? %d" % (Chan,Chan) for Chan in Chans)
+        reply = self.ask(query+" \n\r")
+        values = np.array([float(v.split()[0]) for v in reply.split(';')])
+        self.settle()
+        return values[0::2],values[1::2]
+
+class TemperatureMonitor(object):
+    """
+    Read LakeShore channels in a background thread into a ring buffer of
+    timestamped readings, so logging temperature costs a sweep no time.
+        monitor = TemperatureMonitor(LS,[1,2],interval=1.0)
+        monitor.start()
+        t,T,R = monitor.latest()      # or monitor.at(time.time())
+        monitor.stop()
+    """
+    def __init__(self,lakeshore,Chans,interval=1.0,size=3600):
+        self.lakeshore = lakeshore
+        self.Chans = list(Chans)
+        self.interval = interval
+        self.size = size
+        self.times = np.full(size,np.nan)
+        self.temps = np.full((size,len(self.Chans)),np.nan)
+        self.resistances = np.full((size,len(self.Chans)),np.nan)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        t0 = time.time()
+        temps,resistances = self.lakeshore.readTemps(self.Chans)
+        t = (t0+time.time())/2
+        with self._lock:
+            i = self.count % self.size
+            self.times[i] = t
+            self.temps[i] = temps
+            self.resistances[i] = resistances
+            self.count += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print("ERROR: temperature monitor: %s" % e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,name='TemperatureMonitor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def latest(self):
+        """
+        return time, temperatures and resistances of the last reading,
+        None before the first one
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+            i = (self.count-1) % self.size
+            return self.times[i],self.temps[i].copy(),self.resistances[i].copy()
+
+    def at(self,t):
+        """
+        return the reading nearest to time t (seconds since epoch)
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+            i = np.nanargmin(np.abs(self.times-t))
+            return self.times[i],self.temps[i].copy(),self.resistances[i].copy()
+
+    def history(self):
+        """
+        return all buffered readings ordered in time
+        """
+        with self._lock:
+            n = min(self.count,self.size)
+            order = (np.arange(n)+self.count-n) % self.size
+            return self.times[order],self.temps[order],self.resistances[order]
+
         
 class Anristu_sgen(VisaInstrument):
+    # native language has no *OPC?, blind wait for the synthesizer to lock,
+    # the old fixed 0.2 s until the lock time is measured
+    settleProfile = SettleProfile(minimum=0.2,timeout=0.2)
+    maxListPoints = 2000
+    batchSeparator = '; '
+    errorQuery = None
+    healthQuery = 'OI'
     
     def __init__(self,visaAddress = "GPIB::18::INSTR",name = "Anristu_sgen"):
         self._name = name
@@ -154,39 +850,213 @@ class Anristu_sgen(VisaInstrument):
           print("ERROR: Cannot initialize instrument!")
     
     def setFreqPow(self,freq,power):
-        self.write("CF1 %.8f GH; XL1 %4f DM; PO;XP" % (freq,power))
-        time.sleep(0.2)
+        if self.setCached('freqpow',(freq,power),self.write,"CF1 %.8f GH; XL1 %4f DM; PO;XP" % (freq,power)):
+            self.settle()
     def RFswitch(self,option):
         if option=='ON':
-            self.write('RF1')
+            self.setCached('RF','ON',self.write,'RF1')
         else:
-            self.write('RF0')
+            self.setCached('RF','OFF',self.write,'RF0')
+
+    def loadList(self,freq_GHz,pow_dBm):
+        """
+        upload a frequency/power table into list 0 and step it by manual
+        trigger (stepList). The source sits on the first point.
+        """
+        if len(freq_GHz) > self.maxListPoints:
+            print("list of %d points is longer than %d" % (len(freq_GHz),self.maxListPoints))
+            return False
+        self.invalidateCache()
+        freqs = ', '.join('%.8f GH' % f for f in freq_GHz)
+        powers = ', '.join('%.2f DM' % p for p in pow_dBm)
+        self.write("LST; ELN0; ELI0000; LF %s; LP %s; LIB0000; LIE%04d; MNT" % (freqs,powers,len(freq_GHz)-1))
+        self.settle()
+        return True
+
+    def stepList(self):
+        self.write("TSS")
+        self.settle()
+
+    def stopList(self):
+        """
+        back to CW mode
+        """
+        self.invalidateCache()
+        self.write("CF1")
 
 class Aeroflex(labView):
-    def __init__(self):
+    # the VI has no done indicator, blind wait for the relays of the 8311,
+    # the old fixed 0.2 s until the switching time is measured
+    settleProfile = SettleProfile(minimum=0.2,timeout=0.2)
+
+    def __init__(self,cal=None):
+        """
+        cal: RU_cal.CalTable of the channels, used by BalAtten
+        """
         VIpath = dir_+"Aeroflex8311_SetAttenuation.vi"
         super(Aeroflex,self).initialize(VIpath)
+        self.cal = cal
         self.setAtten(1,0) # zero attenuator on the output line through Aeroflex
     def setAtten(self,CHAN,attenuation):
         paras = ["Channel","Attenuation (dB)"]
         values = [CHAN,int(np.abs(attenuation))]
-        self.VI.Call(paras,values)
-        time.sleep(0.2)
+        if self.setCached(('atten',CHAN),values[1],self.call,paras,values):
+            self.settle()
         return True
     def atten_DRinput(self,attenuation):
         self.setAtten(1,attenuation)
         
-    def BalAtten(self,attenuation):
-        self.setAtten(1,attenuation)
+    def BalAtten(self,attenuation,freq=None):
+        """
+        channel 1 takes attenuation, channel 2 the balancing loss for it
+        freq(GHz): with a calibration table each channel is set to the
+        calibrated loss closest to its target at this frequency
+        return the setting of channel 2
+        """
         if attenuation<30:
             at2=np.ceil((15*np.exp(-attenuation/15)))-1
 #            at2=30-attenuation
         else:
             at2=2
-        print(at2)
+        at1 = attenuation
+        if self.cal is not None and freq is not None:
+            at1 = self.cal.setting(1,attenuation,freq)
+            if self.cal.calibrated(2):
+                at2 = self.cal.setting(2,at2,freq)
+        self.setAtten(1,at1)
         self.setAtten(2,at2)
         return at2
         
+class ListSweep(object):
+    """
+    Step a signal generator through a frequency/power table.
+    Sources with a hardware list (loadList/stepList) get the table in one
+    transfer and advance by trigger; any other source with setFreqPow is
+    set point by point, so sweep scripts do not depend on the source.
+        for freq,power in ListSweep(SGEN1,np.arange(4,7,0.01),-20):
+            result.append(ATS.measure(...))
+    """
+    def __init__(self,source,freq_GHz,pow_dBm,hardware=True):
+        self.source = source
+        self.freq = np.atleast_1d(np.asarray(freq_GHz,dtype=float))
+        self.power = np.broadcast_to(np.asarray(pow_dBm,dtype=float),self.freq.shape)
+        self.hardware = hardware and hasattr(source,'loadList')
+        self.index = -1
+
+    def __len__(self):
+        return self.freq.size
+
+    def start(self):
+        """
+        go to the first point
+        """
+        if self.hardware and not self.source.loadList(self.freq,self.power):
+            self.hardware = False
+        if not self.hardware:
+            self.source.setFreqPow(self.freq[0],self.power[0])
+        self.index = 0
+
+    def step(self):
+        """
+        go to the next point, return its index
+        """
+        self.index += 1
+        if self.hardware:
+            self.source.stepList()
+        else:
+            self.source.setFreqPow(self.freq[self.index],self.power[self.index])
+        return self.index
+
+    def stop(self):
+        if self.hardware:
+            self.source.stopList()
+
+    def __iter__(self):
+        self.start()
+        try:
+            for i in range(len(self)):
+                if i:
+                    self.step()
+                yield self.freq[i],self.power[i]
+        finally:
+            self.stop()
+
+class BiasRamp(object):
+    """
+    Walk the flux bias through a list of B values (uA).
+    The two channel schedule is computed for the whole list at once. With
+    a K2602 that has a TSP address it is loaded into the source meter as one
+    script: mode 'trigger' steps it with one short command per point, mode
+    'slew' lets the instrument walk it at slewRate (uA/s) while the loop
+    follows the schedule. Without the address every point goes through
+    setB_uA, so sweep scripts do not depend on the setup.
+        for B in BiasRamp(bias,np.arange(-500,500,5)):
+            result.append(ATS.measure(freq))
+    minDwell: shortest time (s) a point is held in 'slew' mode
+    """
+    def __init__(self,bias,B_uA,mode='trigger',slewRate=100.0,minDwell=0.001):
+        self.bias = bias
+        self.B = np.atleast_1d(np.asarray(B_uA,dtype=float))
+        if np.any(np.abs(self.B) > 2e3):
+            raise ValueError("current out of limit")
+        self.ch1,self.ch2 = K2602.schedule(self.B*1e-6)
+        self.dwell = np.maximum(np.abs(np.diff(self.B,append=self.B[-1]))/slewRate,minDwell)
+        # start time of each point in 'slew' mode
+        self.times = np.concatenate(([0.0],np.cumsum(self.dwell)[:-1]))
+        self.mode = mode
+        self.scripted = getattr(bias,'tsp',None) is not None
+        self.index = -1
+
+    def __len__(self):
+        return self.B.size
+
+    def start(self):
+        """
+        go to the first point
+        """
+        if self.scripted:
+            self.bias.tsp.loadSchedule(self.ch1,self.ch2,self.dwell)
+            if self.mode == 'slew':
+                self.bias.tsp.runSchedule()
+                self.t0 = time.time()
+        else:
+            self.bias.setB_uA(self.B[0])
+        self.index = 0
+
+    def step(self):
+        """
+        go to the next point, return its index
+        """
+        self.index += 1
+        if not self.scripted:
+            self.bias.setB_uA(self.B[self.index])
+        elif self.mode == 'slew':
+            # a tenth of the dwell late, so the point is surely set
+            wait = self.t0+self.times[self.index]+0.1*self.dwell[self.index]-time.time()
+            if wait > 0:
+                time.sleep(wait)
+            elif self.index+1 < self.B.size and -wait > self.dwell[self.index]:
+                print("WARNING: ramp ahead of the loop at point %d" % self.index)
+        else:
+            self.bias.tsp.stepSchedule(self.index)
+        return self.index
+
+    def stop(self):
+        if self.scripted:
+            # the script changed the currents behind the VI's cache
+            self.bias.cache.pop(('current',1),None)
+            self.bias.cache.pop(('current',2),None)
+
+    def __iter__(self):
+        self.start()
+        try:
+            for i in range(len(self)):
+                if i:
+                    self.step()
+                yield self.B[i]
+        finally:
+            self.stop()
+
 class spectroscopy_File_Header():
     """
     Initialize header to spectroscopy file
@@ -213,34 +1083,162 @@ class spectroscopy_File_Header():
     def num_row(self):
         return np.size(self.labels.split('\t'))
 
+def _toArray(result,dtype='<f8'):
+    """
+    numpy array of a value returned through COM. Buffers (a flattened
+    LabVIEW string arrives as bytes) are wrapped without copying, nested
+    tuples are read in one pass, a row per tuple.
+    """
+    if isinstance(result,(bytes,bytearray,memoryview)):
+        return np.frombuffer(result,dtype)
+    if len(result) and isinstance(result[0],(tuple,list)):
+        cols = len(result[0])
+        return np.fromiter(itertools.chain.from_iterable(result),float,len(result)*cols).reshape((-1,cols))
+    return np.fromiter(result,float,len(result))
+
 class ATS_spec(labView):
-    def __init__(self,num_pts=8192,num_avg=4000,num_buff=1):
+    # LabVIEW ExecState of a VI that is not running (eBad, eIdle)
+    idleStates = (0,1)
+    # seconds a chunk may run before it is aborted and retried
+    runTimeout = 60.0
+    # terminals of raw=True: boolean control and indicator with the records
+    # as flattened little-endian float64 (records, frequencies, I/Q)
+    rawControl = 'Return Raw Records'
+    rawIndicator = 'raw records'
+
+    def __init__(self,num_pts=8192,num_avg=4000,num_buff=1,warmup=True,chunk=None,raw=False):
+        """
+        warmup: run one throwaway measurement, once per process
+        chunk: frequencies per VI run, longer lists are measured in chunks
+        and the next chunk acquires while the previous one is converted
+        raw: the VI returns num_avg single records which are averaged here
+        """
         VIpath = "Z:\\IQ Mixer\\"+"ATS9870_Spect_v1.vi"
         
         super(ATS_spec,self).initialize(VIpath)
         self.num_pts=num_pts
         self.num_avg=num_avg
         self.num_buff=num_buff
+        self.chunk=chunk
+        # VI versions before raw records have no raw control, it is sent
+        # on every run where it exists so a raw run does not leave it on
+        self.rawSupported = self._hasControl(self.rawControl)
+        if raw and not self.rawSupported:
+            print("ERROR: %s has no '%s' control, raw records are off" % (VIpath,self.rawControl))
+            raw = False
+        self.raw=raw
+        if warmup:
+            registry.warmup(VIpath,self.warmup)
+
+    def warmup(self):
         self.measure([4])
-        self.readvalue()
         time.sleep(0.1)
+
+    def _hasControl(self,name):
+        try:
+            self.VI.getcontrolvalue(name)
+            return True
+        except Exception:
+            return False
+
+    def _controls(self):
+        paras = ['Number of Points','#ofAvgs','# of Buffers to Avg']
+        values = [self.num_pts,self.num_avg,self.num_buff]
+        if self.rawSupported:
+            paras.append(self.rawControl)
+            values.append(bool(self.raw))
+        return paras,values
        
     def measure(self,frequency_GHz_List):
         """
-        frequency_GHz_List is numpy array
+        frequency_GHz_List is numpy array or list
+        return (frequencies, 2) array of mag(dB), phase(rad)
         """
-        paras = ['Number of Points','#ofAvgs','# of Buffers to Avg','Frequency(GHz)']
-        if type(frequency_GHz_List) != list:
-            frequency_GHz_List = frequency_GHz_List.tolist()
-        values = [self.num_pts,self.num_avg,self.num_buff,frequency_GHz_List]
-        self.VI.Call(paras,values)
+        freq = np.asarray(frequency_GHz_List,dtype=float).ravel()
+        if self.chunk is not None and freq.size > self.chunk:
+            return self._measureChunks(freq)
+        paras,values = self._controls()
+        self.call(paras+['Frequency(GHz)'],values+[freq.tolist()])
+        self.cache.update(zip(paras,values))
         #time.sleep(0.2)
         return self.readvalue()
+
+    def _measureChunks(self,freq):
+        """
+        run the VI asynchronously on one chunk while the result of the
+        previous chunk is turned into an array and averaged
+        """
+        parts = []
+        pending = None
+        with busLock(self.bus):
+            paras,values = self._controls()
+            for start in range(0,freq.size,self.chunk):
+                pending,converted = self._runChunk(paras,values,freq[start:start+self.chunk].tolist(),pending)
+                if converted is not None:
+                    parts.append(converted)
+        parts.append(self._convert(pending))
+        return np.concatenate(parts)
+
+    def _runChunk(self,paras,values,chunk,previous):
+        """
+        run the VI on one chunk, converting the previous result meanwhile.
+        A run that fails or lasts longer than runTimeout is aborted, the
+        state cache dropped and the chunk retried with a new VI reference
+        like in call.
+        return the raw result of the chunk and the converted previous one
+        """
+        converted = None
+        for attempt in range(registry.retries+1):
+            try:
+                for para,value in zip(paras,values):
+                    self.setCached(para,value,self.VI.setcontrolvalue,para,value)
+                self.VI.setcontrolvalue('Frequency(GHz)',chunk)
+                RU_profile.timed('ATS_spec','VI.Run',self.VI.Run,True)
+                if previous is not None and converted is None:
+                    converted = self._convert(previous)
+                t0 = time.time()
+                while self.VI.ExecState not in self.idleStates:
+                    if time.time()-t0 > self.runTimeout:
+                        raise RuntimeError("run not finished after %g s" % self.runTimeout)
+                    time.sleep(0.001)
+                return self._read(),converted
+            except Exception as e:
+                self.invalidateCache()
+                try:
+                    self.VI.Abort()
+                except Exception:
+                    pass
+                if attempt == registry.retries:
+                    raise
+                print("ERROR: %s chunk failed (%s), reconnecting" % (self.__class__.__name__,e))
+                time.sleep(registry.retryDelay)
+                try:
+                    self.VI = registry.VI(self.VIpath,refresh=True)
+                except Exception as e:
+                    print("ERROR: cannot reconnect %s: %s" % (self.VIpath,e))
+
+    def _read(self):
+        indicator = self.rawIndicator if self.raw else 'appended array'
+        return RU_profile.timed('ATS_spec','readvalue',self.VI.getcontrolvalue,indicator)
+
+    def _convert(self,result):
+        """
+        array of a VI result, raw records are averaged as I/Q
+        """
+        if not self.raw:
+            return _toArray(result)
+        records = _toArray(result).reshape((self.num_avg,-1,2))
+        I = records[...,0].mean(axis=0)
+        Q = records[...,1].mean(axis=0)
+        return np.column_stack((10*np.log10(I**2+Q**2),np.arctan2(Q,I)))
+
     def readvalue(self):
-        result = self.VI.getcontrolvalue('appended array')    
-        return np.array(result)
+        return self._convert(self._read())
 
 class AgilentPSG(VisaInstrument):
+    settleProfile = SettleProfile(minimum=0.0,timeout=1.0,query='*OPC?')
+    maxListPoints = 1601
+
     def __init__(self,visaAddress = "GPIB::19::INSTR",name = "AgilentPSG"):
         self._name = name
         self._visaAddress = visaAddress
@@ -254,22 +1252,72 @@ class AgilentPSG(VisaInstrument):
           print("ERROR: Cannot initialize instrument!")
           self.RFswitch('OFF')
     def setFreq(self,freq_GHz):
-         self.write("FREQ %d MHz\n" % (freq_GHz*1e3))
-         time.sleep(0.2)
-         return self.ask("FREQ:CW?")
+         cmd = "FREQ %d MHz\n" % (freq_GHz*1e3)
+         reply = self.cache.get('freq?')
+         with self.batch():
+             if self.setCached('freq',cmd,self.write,cmd):
+                 self.settle()
+                 reply = self.cache['freq?'] = self.ask("FREQ:CW?")
+         return resolveReply(reply)
     def setPower(self,pow_dBm):
         if pow_dBm >=-140:
-            self.write("OUTP:STAT ON\n")
-            self.write("POW:AMPL %f dBm\n" % pow_dBm)
-            time.sleep(0.2)
-            return self.ask("POW:AMPL?")
+            cmd = "POW:AMPL %f dBm\n" % pow_dBm
+            reply = self.cache.get('power?')
+            with self.batch():
+                self.setCached('output','ON',self.write,"OUTP:STAT ON\n")
+                if self.setCached('power',cmd,self.write,cmd):
+                    self.settle()
+                    reply = self.cache['power?'] = self.ask("POW:AMPL?")
+            return resolveReply(reply)
         else:
             #print('Off')
             self.RFswitch('OFF')
+
+    def setFreqPow(self,freq_GHz,pow_dBm):
+        with self.batch():
+            self.setFreq(freq_GHz)
+            power = self.setPower(pow_dBm)
+        return resolveReply(power)
+
+    def loadList(self,freq_GHz,pow_dBm,dwell=0.001):
+        """
+        upload a frequency/power table in LIST mode, each *TRG (stepList)
+        advances one point. The source sits on the first point.
+        """
+        if len(freq_GHz) > self.maxListPoints:
+            print("list of %d points is longer than %d" % (len(freq_GHz),self.maxListPoints))
+            return False
+        self.invalidateCache()
+        cmds = ["LIST:TYPE LIST",
+                "LIST:FREQ %s" % ','.join('%.0f' % (f*1e9) for f in freq_GHz),
+                "LIST:POW %s" % ','.join('%.2f' % p for p in pow_dBm),
+                "LIST:DWEL %g" % dwell,
+                "LIST:TRIG:SOUR BUS",
+                "FREQ:MODE LIST",
+                "POW:MODE LIST",
+                "OUTP:STAT ON",
+                "INIT:CONT OFF",
+                "INIT"]
+        self.write(';:'.join(cmds)+"\n")
+        self.settle()
+        return True
+
+    def stepList(self):
+        # *OPC? answers once the triggered point is set, one transaction per step
+        self.ask("*TRG;*OPC?\n")
+
+    def stopList(self):
+        """
+        back to CW mode
+        """
+        self.invalidateCache()
+        self.write("FREQ:MODE CW;:POW:MODE FIX\n")
             
     def RFswitch(self,state):
         if state == 'ON' or state =='OFF':
+            self.cache.pop('output',None)
             self.write("OUTP:STAT %s\n"%state)
+            self.cache['output'] = state
         else:
             print('state is not ON nor OFF')
         return self.ask("OUTP?")
@@ -281,11 +1329,12 @@ class HP436A(labView):
 #        self.VI.Call()
 
     def readPower(self):
-        self.VI.Call()
+        self.call()
         result = self.VI.getcontrolvalue('Measurement')
         return result
 
 def popupWin(msg):
+    import ctypes
     ctypes.windll.user32.MessageBoxW(0, msg, "Warning:", 1)
         
          
@@ -13,76 +13,140 @@ import matplotlib.pyplot as plt
 import scipy.optimize as spopt
 from scipy.stats import linregress
 import time, datetime
+import tempfile, contextlib
+import concurrent.futures
+import multiprocessing, queue
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 from matplotlib.ticker import LinearLocator, FormatStrFormatter
 from config import *
+import RU_io
 
-def getxarray(A):
+def getxarray(A,outer=None):
     """
     unwrapping stacked x array to get a singal valued x axis
+    outer: column of the outer sweep variable, one x period lasts until it
+    first changes. Without it the period ends where A returns to its first
+    value. Works for non-uniform and reversed grids, returns a view of A.
     """
-    min_ = A.min()
-    max_ = A.max()
-    step = np.abs(A[1]-A[2])
-    length = int(np.round((max_-min_)/step))+1
-    x = A[0:length]     
-    x = np.array(x)        
-    return x
-
-def magPhase2ReIm(mag,phase):
-    mag = 10**(mag/20)
-    Re = mag*np.cos(phase)
-    Im = mag*np.sin(phase)
+    if outer is not None:
+        change = np.flatnonzero(outer[1:] != outer[0])
+        if change.size:
+            return A[:change[0]+1]
+    repeat = np.flatnonzero(A[1:] == A[0])
+    if repeat.size:
+        return A[:repeat[0]+1]
+    return A
+
+def _outputs(out,shape,dtype,n=2):
+    if out is not None:
+        return out
+    return tuple(np.empty(shape,dtype) for i in range(n))
+
+def magPhase2ReIm(mag,phase,out=None,dtype=None):
+    """
+    mag(dB), phase(rad) arrays of any shape, e.g. whole maps, to Re, Im
+    out: (Re,Im) arrays to write the result into
+    dtype: np.float32 computes in single precision
+    """
+    dtype = dtype or np.float64
+    Re,Im = _outputs(out,np.shape(mag),dtype)
+    np.multiply(mag,np.log(10)/20,out=Re)
+    np.exp(Re,out=Re)
+    np.sin(phase,out=Im)
+    Im *= Re
+    Re *= np.cos(phase,dtype=Re.dtype)
     return Re,Im
-def ReIm2magPhase(Re,Im):
-    Spara = Re+1j*Im
-    mag = 20*np.log10(absolute(Spara))
-    phase = np.angle(Spara)
+def ReIm2magPhase(Re,Im,out=None,dtype=None):
+    """
+    Re, Im arrays of any shape to mag(dB), phase(rad)
+    out: (mag,phase) arrays to write the result into
+    dtype: np.float32 computes in single precision
+    """
+    dtype = dtype or np.float64
+    mag,phase = _outputs(out,np.shape(Re),dtype)
+    np.hypot(Re,Im,out=mag)
+    np.log10(mag,out=mag)
+    mag *= 20
+    np.arctan2(Im,Re,out=phase)
     return mag, phase    
 
+def fitElectricDelay(freq,phase):
+    """
+    least squares line through the unwrapped phase of every trace at once
+    freq: 1D, phase: 1D trace or (freq, traces) map
+    return slope, intercept (arrays with one value per trace for a map)
+    """
+    A = np.column_stack((freq,np.ones_like(freq)))
+    coef = np.linalg.lstsq(A,phase,rcond=None)[0]
+    return coef[0],coef[1]
+
+def removeElectricDelay(freq,mag,phase,single=False,out=None):
+    """
+    Batch S21 processing of a whole to2DZ map, one trace per column:
+    unwrap the phase along frequency, fit all delays in one least squares
+    call, subtract slope*freq and convert to Re/Im.
+    freq: 1D, mag(dB) and phase(rad): (freq, traces)
+    single: compute in float32 to halve memory
+    out: (phase,Re,Im) arrays to write into, phase may be the input itself
+    return phase, Re, Im, slope, intercept
+    """
+    dtype = np.float32 if single else np.float64
+    phase_,Re,Im = _outputs(out,np.shape(phase),dtype,3)
+    phase_[...] = np.unwrap(phase,axis=0)
+    freq = np.asarray(freq,dtype)
+    slope,intercept = fitElectricDelay(freq,phase_)
+    phase_ -= np.multiply.outer(freq,slope) if phase_.ndim > 1 else slope*freq
+    magPhase2ReIm(mag,phase_,out=(Re,Im))
+    return phase_,Re,Im,slope,intercept
+
 class dfile(object):
-    def __init__(self,fname) :
+    def __init__(self,fname,cache=True) :
         """
         get header and data
+        cache: reuse or write a binary sidecar cache (RU_io.loadSidecar)
         """
         self.fname = fname
-        self.header=[]
-        fh = open(self.fname,'r')
-        line = fh.readline()     
-#        print('1: ',line[0])
-        while line[0] == '#':
-            self.header.append(line)
-            line = fh.readline()
+        cached = RU_io.loadSidecar(fname) if cache else None
+        if cached is not None:
+            self.header,self.data = cached
+        else:
+            self.header,data = RU_io.readDat(fname)
+            self.data = self.mergeHeaderRow(data)
+            if cache:
+                RU_io.saveSidecar(fname,self.header,self.data)
 
         self.labels = self.header[0][1:].split()
-        
-        data = np.loadtxt(fname)
-        self.num_cols = data.shape[1]
-
+        self.num_cols = self.data.shape[1]
         if "Data starts from here" not in self.header[-1]:            
             print(self.header[-1])
-        if "VNA Port 1 to Aeroflex CHAN2 to Coupler" in self.header[-1]:
-#            print()
-            temp_row = self.header[-1].split()[-self.num_cols::]        
-            temp_row = [float(s) for s in temp_row]
-            temp_row = np.array(temp_row)
-#            print(temp_row)
-            self.data = temp_row
-            for row in data:
-                self.data=np.vstack((self.data,row))
-        else:
-            self.data = data
         
         self.num_rows = self.data.shape[0]
         self.index = np.arange(self.num_rows)
+
+    def mergeHeaderRow(self,data):
+        """
+        some files have the first data row on the last header line
+        """
+        if "VNA Port 1 to Aeroflex CHAN2 to Coupler" in self.header[-1]:
+            temp_row = self.header[-1].split()[-data.shape[1]::]        
+            temp_row = np.array([float(s) for s in temp_row])
+            return np.vstack((temp_row,data))
+        return data
         
 class TWPAdata(dfile):
     """
     read TWPAdata and change to 2D spreadsheet XYZ
     X must be continously stored as rows and stacked. 
     Y is constant for each X period.
+    Rows with their own X grids (RU_sweep.adaptiveGrid) are put on the
+    union of the grids when a column is reshaped, interpolated between the
+    points of each row; measured is then the (Y,X) mask of measured points.
     """
+    # shared X grid unless perRowGrid finds otherwise
+    rowStarts = None
+    measured = None
+
     def __init__(self,fname,xlabel='SignalFreq(Hz)',ylabel='SignalPow(dBm)'):
         print("Processing %s" % fname)
 
@@ -96,9 +160,38 @@ class TWPAdata(dfile):
             print("Apply S21 Mag correction.")
         except:
             pass
-        self.X = self.getX(xlabel)
-        self.Y = self.getY(ylabel)
+        self.rowStarts = self.perRowGrid(xlabel,ylabel)
+        if self.rowStarts is None:
+            self.X = self.getX(xlabel,ylabel)
+            self.Y = self.getY(ylabel)
+        else:
+            x = self.data[:,self.getIndex(xlabel)]
+            self.X = np.unique(x)
+            self.Y = self.data[self.rowStarts[:-1],self.getIndex(ylabel)]
+            self.measured = np.zeros((self.Y.size,self.X.size),dtype=bool)
+            for i,(s,e) in enumerate(zip(self.rowStarts[:-1],self.rowStarts[1:])):
+                self.measured[i,np.searchsorted(self.X,x[s:e])] = True
+            self._x = x
         #print("Done")
+
+    def perRowGrid(self,xlabel,ylabel):
+        """
+        return the start of every X period and the end of the last one if
+        the periods have different X grids, None if they all share one
+        """
+        x = self.data[:,self.getIndex(xlabel)]
+        y = self.data[:,self.getIndex(ylabel)]
+        starts = np.append(0,np.flatnonzero(y[1:] != y[:-1])+1)
+        if starts.size < 2:
+            return None
+        lengths = np.diff(np.append(starts,y.size))
+        n = lengths[0]
+        # an unfinished last period is no sign of different grids
+        if np.all(lengths[:-1] == n) and lengths[-1] <= n:
+            periods = x[:(starts.size-1)*n].reshape((-1,n))
+            if np.all(periods == periods[0]) and np.all(x[starts[-1]:] == periods[0,:lengths[-1]]):
+                return None
+        return np.append(starts,y.size)
         
     def getParaArray(self,index):
         """
@@ -106,21 +199,41 @@ class TWPAdata(dfile):
         This function is valid for one variable varied, e.g. signal power.
         It is not valid if two are varied, e.g. both signal power and magneitc fied. 
         """
-        x = self.data[:,index]
-        rows = int((self.num_rows/self.X.size))
-        x = np.reshape(x,(rows,self.X.size))
-        y =[]
-        for i in x:
-            y.append(np.average(i))
-        return np.array(y)
+        return self.reshapeColumn(index).mean(axis=1)
+
+    def reshapeColumn(self,index):
+        """
+        return column index as (Y,X) array, a view of data.
+        An unfinished last X period is left out.
+        With per row grids a new array of the rows interpolated on X,
+        phase columns are unwrapped along each row first.
+        """
+        if self.rowStarts is not None:
+            column = self.data[:,index]
+            Z = np.empty((self.Y.size,self.X.size))
+            for i,(s,e) in enumerate(zip(self.rowStarts[:-1],self.rowStarts[1:])):
+                order = np.argsort(self._x[s:e],kind='stable')
+                values = column[s:e][order]
+                if self.labels[index].startswith('Phase'):
+                    values = np.unwrap(values)
+                Z[i] = np.interp(self.X,self._x[s:e][order],values)
+            return Z
+        rows = self.num_rows//self.X.size
+        return self.data[:rows*self.X.size,index].reshape((rows,self.X.size))
         
     def remove_electricDelay(self,freq,phase):
         """
+        phase: one trace or a (freq, traces) map
         return slope, intercept
         """
-        result= linregress(freq,phase)
-        slope,intercept = result[0:2]
-        return slope, intercept
+        return fitElectricDelay(freq,phase)
+
+    def delayCorrected(self,maglabel='Mag(dB)',phaselabel='Phase(rad)',single=False):
+        """
+        return phase with electric delay removed, Re and Im as (X,Y) maps
+        """
+        phase,Re,Im = removeElectricDelay(self.X,self.to2DZ(maglabel),self.to2DZ(phaselabel),single)[0:3]
+        return phase,Re,Im
     def getIndex(self,label):
         """
         return index corresponds to column
@@ -129,43 +242,262 @@ class TWPAdata(dfile):
         
     def getY(self,ylabel):
         return self.getParaArray(self.getIndex(ylabel))
-    def getX(self,xlabel):
-        return getxarray(self.data[:,self.getIndex(xlabel)])
+    def getX(self,xlabel,ylabel=None):
+        outer = None if ylabel is None else self.data[:,self.getIndex(ylabel)]
+        return getxarray(self.data[:,self.getIndex(xlabel)],outer)
         
     def to2DZ(self,zlabel):
         """
         return X,Y as 1D array, Z as 2D array.
+        Z is a (X,Y) view of data, copy it before changing values.
         """
-        i = self.labels.index(zlabel)
-        t = self.data[:,i]
-        Z=[]
-        index = np.reshape(self.index,(self.Y.size,self.X.size))
-        for row in index:
-            Z.append(t[row])
-        Z = np.array(Z)
-        return Z.transpose()
+        return self.reshapeColumn(self.labels.index(zlabel)).transpose()
         
 def getFileList(matchKey,timestamp,fdir):
     """
     input the file name, and time stamp
     timestamp shoud be a 2-d tuple
     output file list
+    Files are looked up in the metadata index of fdir (RU_io.FileIndex).
     """
     entries = []
     time_i = timestamp[0]
     time_f = timestamp[-1]
-    for dfile in os.listdir(fdir):
-        if fnmatch.fnmatch(dfile,matchKey) :    
-            if "PumpON" not in dfile:
-                creationTime = int(dfile.split('.')[0].split('_')[-1])                
-                
-            if (creationTime <=time_f ) and (creationTime>=time_i):
-                print(dfile, "added to list")
-                B_field = float(re.findall('[+-]?\d+',dfile)[-2])                
-                entries.append([B_field,fdir+dfile])
+    for entry in RU_io.fileIndex(fdir).query(matchKey,timestamp=(time_i,time_f)):
+        if entry['B'] is None:
+            print(entry['name'], "has no B field, skipped")
+            continue
+        print(entry['name'], "added to list")
+        entries.append([entry['B'],fdir+entry['name']])
     entries.sort()       # order data in terms of magnetic field
     return entries
 
+def _loadIntoCube(task):
+    """
+    worker of loadCube: read one file and write its map into the cube file
+    """
+    i,fname,zlabel,xlabel,ylabel,cubeName,shape = task
+    entry = TWPAdata(fname,xlabel,ylabel)
+    Z = entry.to2DZ(zlabel).transpose()
+    ny = min(Z.shape[0],shape[1])
+    nx = min(Z.shape[1],shape[2])
+    cube = np.memmap(cubeName,dtype='float64',mode='r+',shape=shape)
+    cube[i,:ny,:nx] = Z[:ny,:nx]
+    cube.flush()
+    return i,Z.shape
+
+def loadCube(entries,zlabel,xlabel='SignalFreq(Hz)',ylabel='SignalPow(dBm)',cubeName=None,processes=None):
+    """
+    Load the TWPAdata files of a B sweep into one (B,Y,X) array.
+    entries: [[B,fname],...] as returned by getFileList
+    cubeName: file backing the cube. By default a temporary file, which
+    the caller removes with os.remove(cube.filename) when done; tempCube
+    does that at the end of a with block.
+    processes: number of worker processes, default all cores
+    Workers write straight into the memory-mapped cube, only indices go
+    back through the pool. X and Y are taken from the first file, maps of
+    other sizes are cut or padded with NaN. On Windows call it under
+    if __name__ == "__main__".
+    return B, X, Y as 1D arrays and the cube as np.memmap
+    """
+    B = np.array([entry[0] for entry in entries],dtype=float)
+    first = TWPAdata(entries[0][1],xlabel,ylabel)
+    X = np.array(first.X)
+    Y = np.array(first.Y)
+    shape = (len(entries),Y.size,X.size)
+    if cubeName is None:
+        fh,cubeName = tempfile.mkstemp(suffix='.cube')
+        os.close(fh)
+    cube = np.memmap(cubeName,dtype='float64',mode='w+',shape=shape)
+    cube[:] = np.nan
+    cube.flush()
+    tasks = [(i,fname,zlabel,xlabel,ylabel,cubeName,shape) for i,(b,fname) in enumerate(entries)]
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        for i,Zshape in pool.map(_loadIntoCube,tasks,chunksize=max(1,len(tasks)//(4*(processes or os.cpu_count() or 1)))):
+            if Zshape != shape[1:]:
+                print("%s is %dx%d, cube is %dx%d" % ((entries[i][1],)+Zshape+shape[1:]))
+    return B,X,Y,np.memmap(cubeName,dtype='float64',mode='r+',shape=shape)
+
+@contextlib.contextmanager
+def tempCube(entries,zlabel,xlabel='SignalFreq(Hz)',ylabel='SignalPow(dBm)',processes=None):
+    """
+    loadCube into a temporary file removed when the block ends
+        with tempCube(entries,'Mag(dB)') as (B,X,Y,cube):
+            gain = cube[:,10,:].copy()
+    Copy what is needed after the block; on Windows the file can only be
+    removed if no other reference to the cube is left.
+    """
+    result = loadCube(entries,zlabel,xlabel,ylabel,None,processes)
+    cubeName = result[3].filename
+    try:
+        yield result
+    finally:
+        del result
+        try:
+            os.remove(cubeName)
+        except OSError as e:
+            print("ERROR: cannot remove %s: %s" % (cubeName,e))
+
+class Pyramid(object):
+    """
+    min/max/mean decimation pyramid of a map Z (Y rows, X columns) for
+    drawing only as many cells as the screen shows. Level 0 is Z, each level
+    halves the dimensions still longer than minSize. NaN cells (not yet
+    measured) are ignored.
+    """
+    def __init__(self,X,Y,Z,minSize=256):
+        self.Z = Z
+        self.X = [np.asarray(X,dtype=float)]
+        self.Y = [np.asarray(Y,dtype=float)]
+        self.factors = [(1,1)]
+        self.levels = [None] # level 0 is read from Z
+        ny,nx = np.shape(Z)
+        while ny > minSize or nx > minSize:
+            fy = 2 if ny > minSize else 1
+            fx = 2 if nx > minSize else 1
+            ny,nx = -(-ny//fy),-(-nx//fx)
+            self.factors.append((fy,fx))
+            self.X.append(_halve(self.X[-1]) if fx == 2 else self.X[-1])
+            self.Y.append(_halve(self.Y[-1]) if fy == 2 else self.Y[-1])
+            self.levels.append({'min':np.empty((ny,nx)),'max':np.empty((ny,nx)),
+                                'sum':np.empty((ny,nx)),'n':np.empty((ny,nx))})
+        self.update()
+
+    def _source(self,level,r0,r1):
+        if level == 0:
+            Z = np.asarray(self.Z[r0:r1],dtype=float)
+            good = np.isfinite(Z)
+            return {'min':Z,'max':Z,'sum':np.where(good,Z,0.0),'n':good.astype(float)}
+        return dict((key,A[r0:r1]) for key,A in self.levels[level].items())
+
+    def update(self,r0=0,r1=None):
+        """
+        recompute the levels after rows r0:r1 of Z changed
+        """
+        if r1 is None:
+            r1 = np.shape(self.Z)[0]
+        for level in range(1,len(self.levels)):
+            fy,fx = self.factors[level]
+            r0,r1 = r0//fy,-(-r1//fy)
+            src = self._source(level-1,r0*fy,r1*fy)
+            out = self.levels[level]
+            out['min'][r0:r1] = np.fmin.reduce(_blocks(src['min'],fy,fx,np.nan),axis=(1,3))
+            out['max'][r0:r1] = np.fmax.reduce(_blocks(src['max'],fy,fx,np.nan),axis=(1,3))
+            out['sum'][r0:r1] = _blocks(src['sum'],fy,fx,0.0).sum(axis=(1,3))
+            out['n'][r0:r1] = _blocks(src['n'],fy,fx,0.0).sum(axis=(1,3))
+
+    def get(self,level,mode='mean'):
+        if level == 0:
+            return self.Z
+        A = self.levels[level]
+        if mode == 'mean':
+            with np.errstate(invalid='ignore',divide='ignore'):
+                return A['sum']/A['n']
+        return A[mode]
+
+    def view(self,xlim,ylim,width,height,mode='mean'):
+        """
+        return level and X, Y, Z of the coarsest level that still has a
+        cell per pixel of a width x height pixel view of xlim, ylim
+        """
+        for level in range(len(self.levels)-1,-1,-1):
+            xs = _inside(self.X[level],xlim)
+            ys = _inside(self.Y[level],ylim)
+            if level == 0 or (xs.stop-xs.start >= width and ys.stop-ys.start >= height):
+                break
+        return level,self.X[level][xs],self.Y[level][ys],self.get(level,mode)[ys,xs]
+
+def _halve(A):
+    """
+    centres of pairs of grid points, an odd last point stays
+    """
+    if A.size % 2:
+        A = np.append(A,A[-1])
+    return A.reshape(-1,2).mean(axis=1)
+
+def _blocks(A,fy,fx,fill):
+    """
+    (rows/fy, fy, columns/fx, fx) view of A, padded with fill to whole blocks
+    """
+    ry,rx = -A.shape[0] % fy,-A.shape[1] % fx
+    if ry or rx:
+        A = np.pad(A,((0,ry),(0,rx)),mode='constant',constant_values=fill)
+    return A.reshape(A.shape[0]//fy,fy,A.shape[1]//fx,fx)
+
+def _inside(A,lim):
+    """
+    slice of A within lim plus one cell on each side
+    """
+    index = np.flatnonzero((A >= min(lim)) & (A <= max(lim)))
+    if index.size == 0:
+        return slice(0,A.size)
+    return slice(max(index[0]-1,0),min(index[-1]+2,A.size))
+
+def _liveRender(messages,X,Y,labels,mode,interval,figname):
+    """
+    renderer process of LivePlot
+    """
+    data = dataXYZ()
+    data.initialize(np.asarray(X),np.asarray(Y),np.full((len(Y),len(X)),np.nan))
+    data.set_labels(*(labels or ['X','Y','Z','']))
+    # interactive, so show() in pcolor returns and the rows get drawn
+    plt.ion()
+    data.pcolor(lod=True,mode=mode)
+    done = False
+    while not done:
+        rows = []
+        try:
+            message = messages.get(timeout=interval)
+            while True:
+                if message is None:
+                    done = True
+                    break
+                i,values = message
+                data.Z[i] = values
+                rows.append(i)
+                message = messages.get_nowait()
+        except queue.Empty:
+            pass
+        if rows:
+            data.update(min(rows),max(rows)+1)
+        plt.pause(0.001)
+    if figname:
+        data.fig.savefig(figname)
+    # keep the window open until it is closed
+    plt.ioff()
+    plt.show()
+
+class LivePlot(object):
+    """
+    Draw a map row by row while it is measured. Drawing runs in its own
+    process fed from a queue, put() returns at once so the sweep loop never
+    waits for the screen.
+        live = LivePlot(X,Y,['Freq(GHz)','B(uA)','Mag(dB)','flux map'])
+        for i,B in enumerate(Y):
+            live.put(i,measureRow(B))
+        live.close()
+    mode: 'mean', 'min' or 'max' of the cells merged on screen
+    interval: seconds between redraws, rows arriving meanwhile are drawn together
+    figname: save the final figure to this file
+    On Windows create it under if __name__ == "__main__".
+    """
+    def __init__(self,X,Y,labels=None,mode='mean',interval=0.2,figname=None):
+        self.messages = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_liveRender,args=(self.messages,X,Y,labels,mode,interval,figname))
+        self.process.daemon = True
+        self.process.start()
+
+    def put(self,row,values):
+        self.messages.put((row,np.asarray(values,dtype=float)))
+
+    def close(self,wait=True):
+        """
+        draw the rest and stop, wait=True waits until the window is closed
+        """
+        self.messages.put(None)
+        if wait:
+            self.process.join()
+
 class dataXYZ(object):
     """
     X,Y are 1D arrays
@@ -189,15 +521,23 @@ class dataXYZ(object):
         read data into X,Y,Z
         the data file should have X and Y as first row and column.
         Z fills the rest of the 2-D array.
+        A binary map (directory saved with binary=True, see RU_io.saveXYZ)
+        is read with Z memory-mapped, slices of it are read on demand.
         """
-        data = np.loadtxt(fname)
-        self.X = data[0,1:]
-        self.Y = data[1:,0]
-        self.Z = data[1:,1:]
+        if os.path.isdir(fname):
+            self.X,self.Y,self.Z,meta = RU_io.loadXYZ(fname)
+            self.header = meta['header']
+        else:
+            data = np.loadtxt(fname)
+            self.X = data[0,1:]
+            self.Y = data[1:,0]
+            self.Z = data[1:,1:]
         self.fname = fname
-    def savetofile(self,fname,**kwargs):
+    def savetofile(self,fname,binary=False,**kwargs):
         """
         **kwargs: Misc to save header from original measurement file
+        binary: save as directory of .npy files and metadata instead of
+        text, e.g. savetofile('map.xyz',binary=True,...)
         """
         header = []
         header.append("# X :%s"%kwargs['x'])
@@ -205,6 +545,13 @@ class dataXYZ(object):
         header.append("# Z :%s"%kwargs['z'])
         header = '\n'.join(header)
         fname = outputDir+fname
+        if binary:
+            if np.shape(self.Z) != (self.Y.size,self.X.size):
+                print("X,Y,Z dimensions don't match. Fail to save file.")
+                return False
+            labels = {'x':kwargs['x'],'y':kwargs['y'],'z':kwargs['z']}
+            RU_io.saveXYZ(fname,self.X,self.Y,self.Z,header+kwargs.get('Misc',''),labels)
+            return True
         with open(fname,'w') as fh:
             fh.write(header)
             if 'Misc' in kwargs:
@@ -227,21 +574,81 @@ class dataXYZ(object):
             print("X,Y,Z dimensions don't match. Fail to save file.")
             return False
             
-    def pcolor(self):
+    def pcolor(self,lod=False,mode='mean'):
+        """
+        lod: draw a decimated level of Z matching the zoom (see Pyramid),
+        redrawn when the axes limits change
+        mode: 'mean', 'min' or 'max' of the merged cells
+        """
         plt.close()
         plt.figure(figsize =(6,6))
         self.fig = plt.gcf()
-        plt.pcolormesh(self.X,self.Y,self.Z)
+        self.ax = plt.gca()
+        self.pyramid = None
+        if lod:
+            self.pyramid = Pyramid(self.X,self.Y,self.Z)
+            self.mode = mode
+            X,Y,Z = self.pyramid.view(self._span(self.X),self._span(self.Y),*self._pixels())[1:]
+        else:
+            X,Y,Z = self.X,self.Y,self.Z
+        self.mesh = plt.pcolormesh(X,Y,Z)
         plt.autoscale(tight=True)
         plt.subplots_adjust(bottom = 0.3,top=0.9)
         plt.show()
-        self.ax = plt.gca()
-        self.timestamp = get_timestamp_from_fname(self.fname)
+        if self.fname:
+            self.timestamp = get_timestamp_from_fname(self.fname)
         plt.xlabel(self.labels[0])
         plt.ylabel(self.labels[1])
         plt.title(self.labels[3])
-        cbar =plt.colorbar()
-        cbar.set_label(self.labels[2])
+        self.cbar =plt.colorbar()
+        self.cbar.set_label(self.labels[2])
+        if lod:
+            self.ax.callbacks.connect('xlim_changed',self._zoomed)
+            self.ax.callbacks.connect('ylim_changed',self._zoomed)
+
+    def _span(self,A):
+        return (np.nanmin(A),np.nanmax(A))
+
+    def _pixels(self):
+        bbox = self.ax.get_window_extent()
+        return int(bbox.width),int(bbox.height)
+
+    def _zoomed(self,ax):
+        self._draw(force=True)
+
+    def _draw(self,force=False):
+        """
+        show the pyramid level of the current view, in place if the mesh
+        keeps its shape
+        """
+        X,Y,Z = self.pyramid.view(self.ax.get_xlim(),self.ax.get_ylim(),*self._pixels(),mode=self.mode)[1:]
+        finite = Z[np.isfinite(Z)]
+        if not force and self.mesh.get_array().shape == Z.shape:
+            self.mesh.set_array(Z)
+        else:
+            norm,cmap = self.mesh.norm,self.mesh.cmap
+            self.ax.set_autoscale_on(False) # keep the zoom of the user
+            self.mesh.remove()
+            self.mesh = self.ax.pcolormesh(X,Y,Z,norm=norm,cmap=cmap)
+            self.cbar.update_normal(self.mesh)
+        if finite.size:
+            self.mesh.set_clim(finite.min(),finite.max())
+        self.fig.canvas.draw_idle()
+
+    def update(self,r0=0,r1=None):
+        """
+        redraw after rows r0:r1 of Z changed, e.g. during acquisition,
+        without building a new figure
+        """
+        if self.pyramid is not None:
+            self.pyramid.update(r0,r1)
+            self._draw()
+            return
+        finite = self.Z[np.isfinite(self.Z)]
+        self.mesh.set_array(self.Z)
+        if finite.size:
+            self.mesh.set_clim(finite.min(),finite.max())
+        self.fig.canvas.draw_idle()
         
     def savefig(self,Dir_,figname,**kwargs):
         """
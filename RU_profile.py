@@ -0,0 +1,175 @@
+"""
+Opt-in latency recording of instrument and file I/O. While a Profiler is
+active every VISA write/ask, LabVIEW VI call, ATS readvalue, settle sleep and
+data file flush is timed and kept in a per-instrument, per-method histogram.
+
+    with RU_profile.profiling() as prof:
+        sweep.run(writer)
+    print(prof.report())
+    prof.toCSV('budget.csv')
+    prof.toJSON('budget.json')
+
+When no profiler is active a timed call costs one global lookup.
+"""
+
+import time, math, threading, contextlib
+
+# the Profiler recording now, None when profiling is off
+active = None
+
+def timed(name,method,func,*args):
+    """
+    return func(*args), recording its latency as name/method if profiling
+    """
+    profiler = active
+    if profiler is None:
+        return func(*args)
+    t0 = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        profiler.record(name,method,time.perf_counter()-t0)
+
+class Histogram(object):
+    """
+    latencies in logarithmic bins, binsPerDecade from 1 us to 1000 s
+    """
+    binsPerDecade = 4
+    low = 1e-6
+    num_bins = 9*4+2 # first and last bin catch under- and overflow
+
+    def __init__(self):
+        self.counts = [0]*self.num_bins
+        self.num = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self,seconds):
+        if seconds > self.low:
+            i = min(int(math.log10(seconds/self.low)*self.binsPerDecade)+1,self.num_bins-1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.num += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def edge(self,i):
+        """
+        upper edge of bin i in seconds
+        """
+        return self.low*10**(float(i)/self.binsPerDecade)
+
+    def percentile(self,q):
+        """
+        upper bin edge below which q percent of the calls fall
+        """
+        if not self.num:
+            return 0.0
+        target = q/100.0*self.num
+        seen = 0
+        for i,count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.edge(i),self.max)
+        return self.max
+
+class Profiler(object):
+    """
+    per (instrument, method) latency histograms and the wall clock time
+    they are compared against
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stop = None
+
+    def record(self,name,method,seconds):
+        key = (name,method)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(seconds)
+
+    def wall(self):
+        return (self.stop or time.perf_counter())-self.start
+
+    def budget(self):
+        """
+        return one dictionary per instrument and method, most time first,
+        and a last 'unaccounted' row for python, plotting etc. Calls made in
+        parallel by applySetpoints overlap, so the rows may add up to more
+        than the wall time.
+        """
+        wall = self.wall()
+        rows = []
+        with self.lock:
+            items = list(self.histograms.items())
+        for (name,method),h in sorted(items,key=lambda item:-item[1].total):
+            rows.append({'instrument':name,'method':method,'calls':h.num,'seconds':h.total,
+                         'percent':100*h.total/wall,'mean_ms':1e3*h.total/h.num,
+                         'p50_ms':1e3*h.percentile(50),'p95_ms':1e3*h.percentile(95),
+                         'max_ms':1e3*h.max})
+        rest = max(wall-sum(row['seconds'] for row in rows),0.0)
+        rows.append({'instrument':'unaccounted','method':'','calls':0,'seconds':rest,
+                     'percent':100*rest/wall,'mean_ms':0.0,'p50_ms':0.0,'p95_ms':0.0,'max_ms':0.0})
+        return rows
+
+    def report(self):
+        lines = ["Time budget of %.3f s wall clock" % self.wall(),
+                 "%-16s %-14s %7s %9s %6s %9s %9s %9s %9s" % ('instrument','method','calls','total(s)','%',
+                                                               'mean(ms)','p50(ms)','p95(ms)','max(ms)')]
+        for row in self.budget():
+            lines.append("%-16s %-14s %7d %9.3f %6.1f %9.3f %9.3f %9.3f %9.3f" % (
+                row['instrument'],row['method'],row['calls'],row['seconds'],row['percent'],
+                row['mean_ms'],row['p50_ms'],row['p95_ms'],row['max_ms']))
+        return '\n'.join(lines)
+
+    def toCSV(self,fname):
+        import csv
+        rows = self.budget()
+        with open(fname,'w') as fh:
+            writer = csv.DictWriter(fh,fieldnames=list(rows[0].keys()),lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def toJSON(self,fname):
+        """
+        budget rows plus the raw histograms (upper bin edges and counts)
+        """
+        import json
+        with self.lock:
+            histograms = [{'instrument':name,'method':method,
+                           'edges_s':[h.edge(i) for i in range(h.num_bins)],'counts':h.counts}
+                          for (name,method),h in self.histograms.items()]
+        with open(fname,'w') as fh:
+            json.dump({'wall_s':self.wall(),'budget':self.budget(),'histograms':histograms},fh,indent=1)
+
+def start():
+    """
+    start recording into a new Profiler and return it
+    """
+    global active
+    active = Profiler()
+    return active
+
+def stop():
+    """
+    stop recording, return the Profiler that was active
+    """
+    global active
+    profiler = active
+    active = None
+    if profiler is not None:
+        profiler.stop = time.perf_counter()
+    return profiler
+
+@contextlib.contextmanager
+def profiling():
+    profiler = start()
+    try:
+        yield profiler
+    finally:
+        stop()
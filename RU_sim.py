@@ -0,0 +1,424 @@
+"""
+Simulated instruments for running RU_meas drivers without lab hardware.
+Each stand-in answers the same commands as the real instrument and waits a
+configurable latency per bus transaction or VI call.
+
+    import RU_sim
+    sim = RU_sim.install(latency=0.005, ATS_spec=0.05)
+    ATS = RU_meas.ATS_spec()
+    print(sim.stats())
+"""
+
+import re, time, ntpath, threading
+import numpy as np
+import RU_meas
+
+#############################################################################
+        #Simulated VISA resources
+
+class SimResource(object):
+    """
+    VISA resource stand-in. A message may hold several commands separated
+    by ';', replies of queries are joined with ';' like SCPI does.
+    """
+    def __init__(self,lab,latency=0.0):
+        self.lab = lab
+        self.latency = latency
+        self.calls = 0
+        self.busy = 0.0
+        self.written = []
+        self.errors = []
+
+    def _transaction(self):
+        t0 = time.time()
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls += 1
+        self.busy += time.time()-t0
+
+    def _run(self,string):
+        replies = []
+        for cmd in string.split(';'):
+            cmd = cmd.strip()
+            if cmd.startswith(':*'):
+                # IEEE 488.2: no colon before a common command
+                self.errors.append('-113,"Undefined header"')
+                continue
+            cmd = cmd.lstrip(':')
+            if cmd:
+                self.written.append(cmd)
+                reply = self.handle(cmd)
+                if reply is not None:
+                    replies.append(str(reply))
+        return replies
+
+    def write(self,string):
+        self._transaction()
+        self._run(string)
+        return len(string)
+
+    def ask(self,string):
+        self._transaction()
+        return ';'.join(self._run(string))
+    query = ask
+
+    def close(self):
+        pass
+
+    def handle(self,cmd):
+        """
+        execute one command, return the reply of a query or None
+        """
+        if cmd == '*IDN?':
+            return self.__class__.__name__
+        if cmd == '*OPC?':
+            return 1
+        if cmd == 'SYST:ERR?':
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+        return None
+
+class SimLakeShore(SimResource):
+    """
+    LakeShore 370: RuOx sensors sitting at the base temperature.
+    """
+    def handle(self,cmd):
+        m = re.match(r'RDG([KR])\?\s*(\d+)',cmd)
+        if m is None:
+            return super(SimLakeShore,self).handle(cmd)
+        chan = int(m.group(2))
+        T = self.lab['temperature'].get(chan,0.02)
+        if m.group(1) == 'K':
+            return '%+.4E' % T
+        return '%+.4E' % (1e3*np.exp(0.1/T**0.5)) # toy RuOx calibration
+
+class SimAnristu_sgen(SimResource):
+    """
+    Anritsu 68/69 series in native GPIB language.
+    """
+    def handle(self,cmd):
+        m = re.match(r'CF1\s*([-+.\dE]+)\s*GH',cmd)
+        if m:
+            self.lab['signal'][0] = float(m.group(1))
+            return None
+        m = re.match(r'XL1\s*([-+.\dE]+)\s*DM',cmd)
+        if m:
+            self.lab['signal'][1] = float(m.group(1))
+            return None
+        if cmd in ('RF1','RF0'):
+            self.lab['signal'][2] = cmd == 'RF1'
+            return None
+        # list sweep
+        if cmd.startswith('LF '):
+            self.listFreq = [float(f.split()[0]) for f in cmd[3:].split(',')]
+            return None
+        if cmd.startswith('LP '):
+            self.listPow = [float(p.split()[0]) for p in cmd[3:].split(',')]
+            return None
+        if cmd == 'MNT':
+            self.listIndex = 0
+            self._listPoint()
+            return None
+        if cmd == 'TSS':
+            self.listIndex = (self.listIndex+1) % len(self.listFreq)
+            self._listPoint()
+            return None
+        return super(SimAnristu_sgen,self).handle(cmd)
+
+    def _listPoint(self):
+        self.lab['signal'][0] = self.listFreq[self.listIndex]
+        self.lab['signal'][1] = self.listPow[self.listIndex]
+
+class SimAgilentPSG(SimResource):
+    """
+    Agilent E8257 PSG, the SCPI subset used by RU_meas.AgilentPSG
+    """
+    def handle(self,cmd):
+        pump = self.lab['pump']
+        m = re.match(r'FREQ\s+([-+.\dE]+)\s*MHz',cmd)
+        if m:
+            pump[0] = float(m.group(1))*1e-3
+            return None
+        m = re.match(r'POW:AMPL\s+([-+.\dE]+)\s*dBm',cmd)
+        if m:
+            pump[1] = float(m.group(1))
+            return None
+        m = re.match(r'OUTP:STAT\s+(ON|OFF)',cmd)
+        if m:
+            pump[2] = m.group(1) == 'ON'
+            return None
+        # list sweep, stepped by bus trigger
+        if cmd.startswith('LIST:FREQ '):
+            self.listFreq = [float(f)*1e-9 for f in cmd.split()[1].split(',')]
+            return None
+        if cmd.startswith('LIST:POW '):
+            self.listPow = [float(p) for p in cmd.split()[1].split(',')]
+            return None
+        if cmd == 'INIT':
+            self.listIndex = 0
+            pump[0],pump[1] = self.listFreq[0],self.listPow[0]
+            return None
+        if cmd == '*TRG':
+            self.listIndex = (self.listIndex+1) % len(self.listFreq)
+            pump[0],pump[1] = self.listFreq[self.listIndex],self.listPow[self.listIndex]
+            return None
+        if cmd == 'FREQ:CW?':
+            return '%+.11E' % (pump[0]*1e9)
+        if cmd == 'POW:AMPL?':
+            return '%+.8E' % pump[1]
+        if cmd == 'OUTP?':
+            return int(pump[2])
+        return super(SimAgilentPSG,self).handle(cmd)
+
+class SimK2602TSP(SimResource):
+    """
+    Keithley 2602 in TSP, the bias script of RU_meas.K2602TSP: tables
+    uploaded in a loadscript block, biasStep(i) and biasRun()
+    """
+    def handle(self,cmd):
+        if cmd.startswith('loadscript'):
+            self.script = []
+            return None
+        if getattr(self,'script',None) is not None and cmd != 'endscript':
+            self.script.append(cmd)
+            return None
+        if cmd == 'endscript':
+            self.lines,self.script = self.script,None
+            return None
+        if cmd == 'RUbias()':
+            self.tables = {}
+            for line in self.lines:
+                m = re.match(r'(\w+) = \{\}$',line)
+                if m:
+                    self.tables[m.group(1)] = []
+                m = re.match(r'for _,v in ipairs\(\{(.*)\}\) do table.insert\((\w+),v\) end',line)
+                if m:
+                    self.tables[m.group(2)].extend(float(v) for v in m.group(1).split(','))
+            self._step(1)
+            return None
+        m = re.match(r'biasStep\((\d+)\)',cmd)
+        if m:
+            self._step(int(m.group(1)))
+            return None
+        if cmd == 'biasRun()':
+            self.running = threading.Thread(target=self._run_table)
+            self.running.start()
+            return None
+        return super(SimK2602TSP,self).handle(cmd)
+
+    def _step(self,i):
+        self.lab['current'][1] = self.tables['biasA'][i-1]
+        self.lab['current'][2] = self.tables['biasB'][i-1]
+
+    def _run_table(self):
+        # delay() on the instrument keeps time, do not let sleeps add up
+        t = time.time()
+        for i in range(1,len(self.tables['biasA'])+1):
+            self._step(i)
+            t += self.tables['biasT'][i-1]
+            time.sleep(max(t-time.time(),0))
+
+#############################################################################
+        #Simulated LabVIEW VIs
+
+class SimVI(object):
+    """
+    LabVIEW VI reference stand-in: Call(paras,values) sets controls and runs.
+    """
+    def __init__(self,lab,latency=0.0):
+        self.lab = lab
+        self.latency = latency
+        self.calls = 0
+        self.busy = 0.0
+        self.controls = {}
+        self._running = None
+
+    def _transaction(self):
+        t0 = time.time()
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls += 1
+        self.busy += time.time()-t0
+
+    def _FlagAsMethod(self,name):
+        pass
+
+    def Call(self,paras=None,values=None):
+        self._transaction()
+        if paras is not None:
+            self.controls.update(zip(paras,values))
+        self.run()
+
+    def Run(self,Async=False):
+        """
+        run with the current controls, Async returns at once and
+        ExecState tells when the run is over
+        """
+        if not Async:
+            self._transaction()
+            self.run()
+            return
+        self._running = threading.Thread(target=self._runAsync)
+        self._running.start()
+
+    def Abort(self):
+        # the simulated run finishes in the background, the VI reports idle
+        self._running = None
+
+    def _runAsync(self):
+        self._transaction()
+        self.run()
+
+    @property
+    def ExecState(self):
+        # LabVIEW eRunning while an asynchronous run is going, else eIdle
+        return 3 if self._running is not None and self._running.is_alive() else 1
+
+    def getcontrolvalue(self,name):
+        self._transaction()
+        return self.controls[name]
+    GetControlValue = getcontrolvalue
+
+    def setcontrolvalue(self,name,value):
+        self._transaction()
+        self.controls[name] = value
+    SetControlValue = setcontrolvalue
+
+    def run(self):
+        pass
+
+class SimK2602(SimVI):
+    def run(self):
+        chan = int(self.controls["Channel (1or2)"])
+        self.lab['current'][chan] = float(self.controls['Set Current (A)'])
+
+class SimGigatronics(SimVI):
+    def run(self):
+        self.lab['pump'][0] = float(self.controls["Frequency (GHz)"])
+        self.lab['pump'][1] = float(self.controls["Power (dBm)"])
+
+class SimAeroflex(SimVI):
+    def run(self):
+        chan = int(self.controls["Channel"])
+        self.lab['atten'][chan] = float(self.controls["Attenuation (dB)"])
+
+class SimHP436A(SimVI):
+    """
+    power meter behind Aeroflex channel 1, fed by the Anritsu source. The
+    attenuator steps are 2 % larger than nominal.
+    """
+    def run(self):
+        power = self.lab['signal'][1]-1.02*self.lab['atten'][1]-0.3-0.02*self.lab['signal'][0]
+        self.controls['Measurement'] = power+np.random.normal(0,0.01)
+
+class SimATS_spec(SimVI):
+    """
+    ATS9870 spectrum VI. 'appended array' holds one (mag(dB),phase(rad)) row
+    per frequency of a flux tunable resonance. With 'Return Raw Records' on,
+    'raw records' holds #ofAvgs single records of I/Q per frequency as bytes.
+    """
+    # digitizer time per frequency on top of the call latency
+    secondsPerFreq = 0.0
+
+    def __init__(self,lab,latency=0.0):
+        super(SimATS_spec,self).__init__(lab,latency)
+        self.controls['Return Raw Records'] = False
+
+    def run(self):
+        freq = np.asarray(self.controls['Frequency(GHz)'],dtype=float)
+        if self.secondsPerFreq:
+            t0 = time.time()
+            time.sleep(freq.size*self.secondsPerFreq)
+            self.busy += time.time()-t0
+        B = self.lab['current'][1]+self.lab['current'][2]
+        f0 = 6.0*np.sqrt(np.abs(np.cos(np.pi*B/4e-3)))+1.0
+        x = 2*(freq-f0)/0.01
+        S21 = 1-0.8/(1+1j*x)
+        noise = np.random.normal(0,1,freq.size)/np.sqrt(max(self.controls['#ofAvgs'],1))
+        mag = 20*np.log10(np.abs(S21))+noise
+        phase = np.angle(S21)-2*np.pi*freq*50e-3
+        self.controls['appended array'] = tuple(map(tuple,np.vstack((mag,phase)).T))
+        if self.controls.get('Return Raw Records'):
+            S21 = S21*np.exp(-2j*np.pi*freq*50e-3)
+            records = np.empty((self.controls['#ofAvgs'],freq.size,2))
+            records[...,0] = S21.real+np.random.normal(0,0.1,records.shape[:2])
+            records[...,1] = S21.imag+np.random.normal(0,0.1,records.shape[:2])
+            self.controls['raw records'] = records.astype('<f8').tobytes()
+
+#############################################################################
+        #Backend
+
+class SimBackend(object):
+    """
+    RU_meas backend answering with simulated instruments.
+    latency: default seconds per bus transaction or VI call
+    **kwargs: per instrument latency, keyed by driver class name, e.g. ATS_spec=0.05
+    """
+    addresses = {"GPIB::12::INSTR":SimLakeShore,
+                 "GPIB::18::INSTR":SimAnristu_sgen,
+                 "GPIB::19::INSTR":SimAgilentPSG,
+                 "GPIB::26::INSTR":SimK2602TSP}
+    VIs = {"K2602A_SetCurrent.vi":SimK2602,
+           "Gigatronics910_SetFreqLevel.vi":SimGigatronics,
+           "Aeroflex8311_SetAttenuation.vi":SimAeroflex,
+           "HP 436A Read Single Measurement.vi":SimHP436A,
+           "ATS9870_Spect_v1.vi":SimATS_spec}
+
+    def __init__(self,latency=0.0,**kwargs):
+        self.latency = latency
+        self.latencies = kwargs
+        self.instruments = {}
+        self.lab = {'temperature':{1:0.02,2:0.8},
+                    'current':{1:0.0,2:0.0},
+                    'atten':{1:0.0,2:0.0},
+                    'signal':[4.0,-20.0,True], # freq(GHz), power(dBm), RF on
+                    'pump':[5.0,-140.0,False]}
+
+    def _create(self,key,simclass):
+        if key not in self.instruments:
+            name = simclass.__name__[3:]
+            self.instruments[key] = simclass(self.lab,self.latencies.get(name,self.latency))
+        return self.instruments[key]
+
+    def open_resource(self,visaAddress):
+        if visaAddress not in self.addresses:
+            raise ValueError("no simulated instrument at %s" % visaAddress)
+        return self._create(visaAddress,self.addresses[visaAddress])
+
+    def getvireference(self,VIpath):
+        VIname = ntpath.basename(VIpath)
+        if VIname not in self.VIs:
+            raise ValueError("no simulated VI %s" % VIname)
+        return self._create(VIname,self.VIs[VIname])
+
+    def setLatency(self,name,latency):
+        """
+        name: driver class name, e.g. 'K2602'
+        """
+        self.latencies[name] = latency
+        for sim in self.instruments.values():
+            if sim.__class__.__name__[3:] == name:
+                sim.latency = latency
+
+    def stats(self):
+        """
+        return {instrument name: (number of calls, seconds busy)}
+        """
+        result = {}
+        for sim in self.instruments.values():
+            name = sim.__class__.__name__[3:]
+            calls,busy = result.get(name,(0,0.0))
+            result[name] = (calls+sim.calls,busy+sim.busy)
+        return result
+
+    def resetStats(self):
+        for sim in self.instruments.values():
+            sim.calls = 0
+            sim.busy = 0.0
+
+def install(latency=0.0,**kwargs):
+    """
+    make RU_meas use a new SimBackend and return it
+    """
+    backend = SimBackend(latency,**kwargs)
+    RU_meas.setBackend(backend)
+    return backend
@@ -0,0 +1,288 @@
+"""
+Declarative N-dimensional sweeps. Each axis is bound to a driver setter
+and a cost model; the engine picks the loop nesting and walks the grid
+back and forth (serpentine) so slow axes change as rarely as possible.
+Rows are written in the order they are measured; run without a writer,
+RU_io.readStream and RU_io.toDat return them in grid order, as TWPAdata
+and dataXYZ expect.
+
+    sweep = Sweep([Axis('B(uA)',np.arange(-500,500,10),bias.setB_uA),
+                   Axis('Atten(dB)',np.arange(0,40,2),attBank.BalAtten)],
+                  measure=lambda: ATS.measure(freq),
+                  labels=['Mag(dB)','Phase(rad)'])
+    print(sweep.describe())
+    with RU_io.StreamWriter(fname,sweep) as writer:
+        sweep.run(writer,checkpoint=fname+'.ckpt')
+
+After a crash the same sweep continues where the checkpoint left it:
+
+    sweep.resume(fname+'.ckpt')
+
+adaptiveGrid measures a trace on a frequency grid refined around features.
+Each row of a map keeps its own grid, TWPAdata reads such files:
+
+    sweep = Sweep([Axis('B(uA)',np.arange(-500,500,10),bias.setB_uA)],
+                  measure=lambda: np.column_stack(adaptiveGrid(ATS.measure,4,8)),
+                  labels=['Freq(GHz)','Mag(dB)','Phase(rad)'])
+"""
+
+import os, time, json, itertools
+import numpy as np
+import RU_io, RU_profile
+
+class Axis(object):
+    """
+    name: column label
+    values: setpoints in the order they should be visited
+    setter: callable(value), e.g. K2602.setB_uA
+    cost: seconds per change, or callable(old,new) for step dependent
+    costs such as a current ramp. Default is the minimum settle time of the
+    instrument the setter belongs to.
+    """
+    def __init__(self,name,values,setter,cost=None):
+        self.name = name
+        self.values = np.atleast_1d(values)
+        self.setter = setter
+        if cost is None:
+            profile = getattr(getattr(setter,'__self__',None),'settleProfile',None)
+            cost = profile.minimum if profile is not None else 0.0
+        self.cost = cost
+
+    def __len__(self):
+        return self.values.size
+
+    def stepCost(self,old,new):
+        if callable(self.cost):
+            return self.cost(old,new)
+        return self.cost
+
+    def passCost(self):
+        """
+        return cost of one pass over the values forward, backward, and of
+        jumping back from the last value to the first
+        """
+        v = self.values
+        forward = sum(self.stepCost(v[i],v[i+1]) for i in range(v.size-1))
+        backward = sum(self.stepCost(v[i+1],v[i]) for i in range(v.size-1))
+        return forward,backward,self.stepCost(v[-1],v[0])
+
+class Sweep(object):
+    """
+    axes: list of Axis, order does not matter
+    measure: callable returning one row or a 2D block of rows per point
+    labels: column labels of the measured values
+    measureTime: estimated seconds per measurement, for the run time estimate
+    serpentine: reverse inner axes on every outer step instead of jumping back
+    nesting: axis names outermost first, default chosen by cost
+    The sweep has labels and header() so it can be given to RU_io.StreamWriter.
+    """
+    def __init__(self,axes,measure,labels=(),measureTime=0.0,serpentine=True,nesting=None,note=()):
+        self.axes = list(axes)
+        self.measure = measure
+        self.measureTime = measureTime
+        self.serpentine = serpentine
+        self.note = list(note)
+        self.labels = '#'+'\t'.join([axis.name for axis in self.axes]+list(labels))
+        if nesting is None:
+            self.nesting = self.bestNesting()
+        else:
+            names = [axis.name for axis in self.axes]
+            self.nesting = [self.axes[names.index(name)] for name in nesting]
+
+    def grid(self):
+        """
+        columns and sizes of the axes outermost first, for putting rows
+        back in grid order (RU_io.readStream)
+        """
+        return {'columns':[self.axes.index(axis) for axis in self.nesting],
+                'sizes':[len(axis) for axis in self.nesting],'serpentine':self.serpentine}
+
+    def header(self):
+        header = [self.labels]
+        header.append("Sweep nesting: %s" % ' > '.join(axis.name for axis in self.nesting))
+        header.extend(self.note)
+        header.append('Data starts from here :\n')
+        return "\n#".join(header)
+
+    def num_points(self):
+        return int(np.prod([len(axis) for axis in self.axes]))
+
+    def settleCost(self,nesting):
+        """
+        return {axis name: seconds spent changing it} for a nesting order
+        """
+        costs = {}
+        outer = 1
+        for axis in nesting:
+            forward,backward,jump = axis.passCost()
+            if self.serpentine:
+                passes = (outer+1)//2*forward+outer//2*backward
+            else:
+                passes = outer*forward+(outer-1)*jump
+            costs[axis.name] = passes
+            outer *= len(axis)
+        return costs
+
+    def bestNesting(self):
+        """
+        the nesting with the least settle time, tried exhaustively for up
+        to 6 axes, else slowest axis outermost
+        """
+        if len(self.axes) <= 6:
+            return list(min(itertools.permutations(self.axes),key=lambda n:sum(self.settleCost(n).values())))
+        return sorted(self.axes,key=lambda axis:-sum(axis.passCost()[0:2])/max(len(axis)-1,1))
+
+    def estimate(self):
+        """
+        return estimated seconds per axis, for measuring and in total
+        """
+        costs = self.settleCost(self.nesting)
+        costs['measure'] = self.measureTime*self.num_points()
+        costs['total'] = sum(costs.values())
+        return costs
+
+    def describe(self):
+        lines = ["%d points, nesting %s" % (self.num_points(),' > '.join(axis.name for axis in self.nesting))]
+        for name,seconds in self.estimate().items():
+            lines.append("  %-16s %10.1f s" % (name,seconds))
+        return '\n'.join(lines)
+
+    def indices(self):
+        """
+        yield index tuples in nesting order, serpentine if enabled
+        """
+        sizes = [len(axis) for axis in self.nesting]
+        for index in RU_io.gridOrder(sizes,self.serpentine):
+            yield tuple(index.tolist())
+
+    def run(self,writer=None,start=0,checkpoint=None,checkpointInterval=10.0):
+        """
+        set the axes that changed, measure and write one row block per point
+        writer: e.g. RU_io.StreamWriter; without it the rows are returned
+        in grid order
+        start: number of points already done, they are skipped
+        checkpoint: file written every checkpointInterval seconds with the
+        points done and the setpoints, needs a RU_io.StreamWriter
+        """
+        print(self.describe())
+        rows = []
+        positions = []
+        sizes = [len(axis) for axis in self.nesting]
+        previous = None
+        order = [self.axes.index(axis) for axis in self.nesting]
+        t0 = lastCheckpoint = time.time()
+        checkpointTime = 0.0
+        for k,index in enumerate(self.indices()):
+            if k < start:
+                continue
+            values = [None]*len(self.axes)
+            for d,axis in enumerate(self.nesting):
+                values[order[d]] = axis.values[index[d]].tolist()
+                if previous is None or previous[d] != index[d]:
+                    axis.setter(values[order[d]])
+            result = np.atleast_2d(self.measure())
+            block = np.column_stack((np.tile(np.array(values,dtype=float),(result.shape[0],1)),result))
+            if writer is None:
+                rows.append(block)
+                positions.append(np.ravel_multi_index(index,sizes))
+            else:
+                writer.appendRows(block)
+            previous = index
+            if checkpoint is not None and time.time()-lastCheckpoint > checkpointInterval:
+                lastCheckpoint = time.time()
+                self._checkpoint(checkpoint,writer,k+1,values)
+                checkpointTime += time.time()-lastCheckpoint
+        if checkpoint is not None and previous is not None:
+            t1 = time.time()
+            self._checkpoint(checkpoint,writer,k+1,values)
+            checkpointTime += time.time()-t1
+            print("Checkpoints took %.3f %% of the sweep" % (100*checkpointTime/max(time.time()-t0,1e-9)))
+        if writer is None:
+            return np.vstack([rows[i] for i in np.argsort(positions,kind='stable')]) if rows else None
+
+    def _checkpoint(self,fname,writer,done,values):
+        """
+        flush the writer and record how far the data file is valid. The
+        file is replaced in one step so a crash leaves the old or the new one.
+        """
+        writer.flush()
+        state = {'data':writer.fname,'end':writer.end,'done':done,
+                 'num_points':self.num_points(),'nesting':[axis.name for axis in self.nesting],
+                 'setpoints':dict((axis.name,value) for axis,value in zip(self.axes,values)),
+                 'time':time.time()}
+        RU_profile.timed('Sweep','checkpoint',_writeJSON,fname,state)
+
+    def resume(self,checkpoint,**kwargs):
+        """
+        continue the sweep of a checkpoint file: rows written after the
+        checkpoint are dropped from the data file, which is appended to
+        without rewriting it, the finished points are skipped and every axis
+        is set again for the first new point
+        **kwargs: passed to run
+        """
+        with open(checkpoint,'r') as fh:
+            state = json.load(fh)
+        if state['num_points'] != self.num_points() or state['nesting'] != [axis.name for axis in self.nesting]:
+            raise ValueError("%s is a checkpoint of another sweep" % checkpoint)
+        print("Resuming at point %d of %d, last setpoints %s" % (state['done'],state['num_points'],state['setpoints']))
+        with RU_io.StreamWriter(state['data'],end=state['end']) as writer:
+            self.run(writer,start=state['done'],checkpoint=checkpoint,**kwargs)
+
+def _writeJSON(fname,state):
+    with open(fname+'.tmp','w') as fh:
+        json.dump(state,fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(fname+'.tmp',fname)
+
+#############################################################################
+        #Adaptive frequency grids
+
+def adaptiveGrid(measure,start,stop,coarse=51,budget=400,tol=1e-3,batch=None,minStep=0.0):
+    """
+    Measure a trace on a frequency grid refined where the response changes.
+    measure(freq): (freq.size, 2) array of mag(dB), phase(rad), e.g. ATS.measure
+    Starts with coarse points from start to stop, then measures the midpoints
+    of the batch intervals with the largest loss, until budget points are
+    measured or no interval loss is above tol. Intervals shorter than
+    2*minStep are not split. The default batch reaches the budget in 12
+    refining calls of measure.
+    return sorted frequencies and their (freq.size, 2) values
+    """
+    freq = np.linspace(start,stop,coarse)
+    values = np.asarray(measure(freq),dtype=float)
+    batch = batch or max(-(-(budget-coarse)//12),1)
+    while freq.size < budget:
+        loss = _intervalLoss(freq,values)
+        loss[np.diff(freq) < 2*minStep] = 0
+        worst = np.argsort(loss)[::-1][:min(batch,budget-freq.size)]
+        worst = np.sort(worst[loss[worst] > tol])
+        if worst.size == 0:
+            break
+        new = (freq[worst]+freq[worst+1])/2
+        freq = np.concatenate((freq,new))
+        values = np.vstack((values,np.asarray(measure(new),dtype=float)))
+        order = np.argsort(freq,kind='stable')
+        freq,values = freq[order],values[order]
+    return freq,values
+
+def _intervalLoss(freq,values):
+    """
+    loss of each interval: its length in normalized (freq, mag, phase)
+    space, large where the response is steep, plus the areas of the
+    triangles it forms with its neighbours, large where it is curved.
+    mag is scaled to its range, phase is unwrapped, freed of its linear
+    electric delay and counted in units of pi.
+    """
+    x = (freq-freq[0])/(freq[-1]-freq[0])
+    mag = values[:,0]
+    m = (mag-mag.min())/(np.ptp(mag) or 1.0)
+    phase = np.unwrap(values[:,1])
+    p = (phase-np.polyval(np.polyfit(x,phase,1),x))/np.pi
+    points = np.column_stack((x,m,p))
+    loss = np.sqrt((np.diff(points,axis=0)**2).sum(axis=1))
+    if freq.size > 2:
+        area = 0.5*np.linalg.norm(np.cross(points[:-2]-points[1:-1],points[2:]-points[1:-1]),axis=1)
+        loss[1:] += area
+        loss[:-1] += area
+    return loss